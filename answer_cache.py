@@ -0,0 +1,132 @@
+# Cache of answers. Fans ask the same things over and over, so a question asked before gets the stored answer
+# without a request to chatGPT. With a similarity threshold, questions close enough to an answered one by the
+# embedding share its answer too; benchmarks/eval_answer_cache.py shows how thresholds treat paraphrases and near misses
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from embedding_cache import normalized_query
+from knowledge_base import normalized
+
+
+class AnswerCache:
+    """Size-bounded cache of answers looked up by the normalized question or by cosine similarity of its embedding."""
+
+    def __init__(
+        self,
+        threshold: float | None = None, # minimum cosine similarity of two questions to share an answer, None looks up only the same question
+        max_size: int = 1000, # maximum number of answers, the least recently used one is evicted first
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Drops all answers, e.g. after the knowledge base has been rebuilt."""
+        with self._lock:
+            self._embeddings = None # (max_size, dim) matrix of normalized question embeddings, allocated on first use
+            self._answers = [None] * self.max_size
+            self._models = np.full(self.max_size, None, dtype=object)
+            self._last_used = np.zeros(self.max_size, dtype=np.int64)
+            self._count = 0
+            self._clock = 0 # increases on every access to track which answers were used recently
+            self._kb_version = None
+            # Answers by model and normalized question
+            self._by_query = OrderedDict()
+
+    def _check_version(self, kb_version: str) -> None:
+        # Answers given from an older knowledge base may be outdated
+        if self._kb_version != kb_version:
+            self._count = 0
+            self._by_query.clear()
+            self._kb_version = kb_version
+
+    def get(
+        self,
+        query_embedding: np.ndarray, # embedding of the question
+        model: str, # model that gave the answers
+        kb_version: str, # version of the knowledge base the answer must come from
+    ) -> str | None:
+        """Returns the answer to the most similar cached question if it is similar enough, otherwise None."""
+        if self.threshold is None:
+            return None
+        with self._lock:
+            self._check_version(kb_version)
+            if self._count:
+                relatednesses = self._embeddings[:self._count] @ normalized(query_embedding)
+                relatednesses[self._models[:self._count] != model] = -1
+                best = int(np.argmax(relatednesses))
+                if relatednesses[best] >= self.threshold:
+                    self._clock += 1
+                    self._last_used[best] = self._clock
+                    self.hits += 1
+                    return self._answers[best]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        query_embedding: np.ndarray, # embedding of the question
+        model: str, # model that gave the answer
+        kb_version: str, # version of the knowledge base the answer came from
+        answer: str, # answer to store
+    ) -> None:
+        """Stores the answer to the question, if questions are looked up by similarity."""
+        if self.threshold is None or self.max_size == 0:
+            return
+        with self._lock:
+            self._check_version(kb_version)
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_size, np.shape(query_embedding)[-1]), dtype=np.float32)
+            if self._count < self.max_size:
+                slot = self._count
+                self._count += 1
+            else:
+                slot = int(np.argmin(self._last_used)) # evict the least recently used answer
+            self._embeddings[slot] = normalized(query_embedding)
+            self._answers[slot] = answer
+            self._models[slot] = model
+            self._clock += 1
+            self._last_used[slot] = self._clock
+
+    def get_query(
+        self,
+        query: str, # the question
+        model: str, # model that gave the answers
+        kb_version: str, # version of the knowledge base the answer must come from
+    ) -> str | None:
+        """Returns the answer to the same question, questions are compared after normalization."""
+        key = (model, normalized_query(query))
+        with self._lock:
+            self._check_version(kb_version)
+            answer = self._by_query.get(key)
+            if answer is None:
+                self.misses += 1
+                return None
+            self._by_query.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def put_query(
+        self,
+        query: str, # the question
+        model: str, # model that gave the answer
+        kb_version: str, # version of the knowledge base the answer came from
+        answer: str, # answer to store
+    ) -> None:
+        """Stores the answer to the question by the question itself."""
+        key = (model, normalized_query(query))
+        with self._lock:
+            self._check_version(kb_version)
+            self._by_query[key] = answer
+            self._by_query.move_to_end(key)
+            while len(self._by_query) > self.max_size:
+                self._by_query.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Returns hit and miss counters and the number of cached answers."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._count + len(self._by_query)}
@@ -0,0 +1,73 @@
+# Benchmark of the approximate IVF index against exact search: recall@k and search latency for several nprobe values.
+# Runs on the knowledge base store or on a synthetic clustered corpus:
+#   python benchmarks/ann_recall.py --store "Man United"
+#   python benchmarks/ann_recall.py --size 200000 --dim 1536 --nprobe 4 8 16 32
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+# The indexes live in the bot package one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from knowledge_base import KnowledgeBase, normalized
+from vector_index import ExactIndex, IVFIndex
+
+
+# Embeddings of real texts form clusters, so the synthetic corpus is a mixture of gaussians around random centers
+def synthetic_embeddings(size: int, dim: int, n_clusters: int, seed: int = 0) -> np.ndarray:
+    """Returns a (size, dim) matrix of normalized embeddings grouped into clusters."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    embeddings = centers[rng.integers(n_clusters, size=size)] + 0.5 * rng.normal(size=(size, dim)).astype(np.float32)
+    return normalized(embeddings)
+
+
+def timed_search(index, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    """Returns the indices found for every query and the mean search time per query in milliseconds."""
+    start = time.perf_counter()
+    indices = np.stack([index.search(query[None, :], k)[0][0] for query in queries])
+    return indices, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall_at_k(found: np.ndarray, expected: np.ndarray) -> float:
+    """Returns the share of the exact top k results that were also found."""
+    return float(np.mean([len(np.intersect1d(f, e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and latency of the IVF index against exact search")
+    parser.add_argument("--store", help="knowledge base store path without extension, synthetic corpus if not given")
+    parser.add_argument("--size", type=int, default=100000, help="number of synthetic embeddings")
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of synthetic embeddings")
+    parser.add_argument("--clusters", type=int, default=500, help="number of clusters in the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries")
+    parser.add_argument("--k", type=int, default=100, help="number of results per query")
+    parser.add_argument("--lists", type=int, default=None, help="number of IVF clusters, 4 * sqrt(n) by default")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32], help="nprobe values to try")
+    args = parser.parse_args()
+
+    if args.store:
+        embeddings = KnowledgeBase.load(args.store).embeddings
+    else:
+        embeddings = synthetic_embeddings(args.size, args.dim, args.clusters)
+    # Queries are perturbed knowledge base embeddings, like questions close to some of the articles
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.integers(len(embeddings), size=args.queries)]
+    queries = normalized(queries + 0.1 * rng.normal(size=queries.shape).astype(np.float32))
+
+    start = time.perf_counter()
+    ivf = IVFIndex.build(embeddings, n_lists=args.lists)
+    print(f"{len(embeddings)} embeddings, {len(ivf.centroids)} clusters built in {time.perf_counter() - start:.1f} s")
+
+    expected, exact_ms = timed_search(ExactIndex(embeddings), queries, args.k)
+    print(f"exact      recall@{args.k} 1.000  {exact_ms:8.2f} ms/query")
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        found, ivf_ms = timed_search(ivf, queries, args.k)
+        print(f"nprobe={nprobe:<4d} recall@{args.k} {recall_at_k(found, expected):.3f}  {ivf_ms:8.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
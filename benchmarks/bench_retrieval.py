@@ -0,0 +1,190 @@
+# Offline benchmarks of retrieval and prompt assembly on a synthetic knowledge base, with the OpenAI clients
+# replaced by local stubs so no network is used. Reports latency percentiles, throughput and peak memory of
+# every case and writes them to JSON, so two runs can be compared:
+#   python benchmarks/bench_retrieval.py --size 20000 --dim 1536 --output before.json
+#   python benchmarks/bench_retrieval.py --size 20000 --dim 1536 --output after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+
+# The bot modules live one level up and the chunking functions in the database directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "database"))
+from knowledge_base import KnowledgeBase, normalized
+from vector_index import IVFIndex
+from context_selection import select_context
+
+WORDS = (
+    "manchester united old trafford busby babes treble premier league cup final goal season manager captain "
+    "ferguson charlton best law cantona giggs scholes keane rooney ronaldo 1968 1999 2008 munich europe champions"
+).split()
+
+
+def synthetic_knowledge_base(size: int, dim: int, words_per_text: int, seed: int = 0) -> KnowledgeBase:
+    """Returns a knowledge base of random texts with headings and random normalized embeddings."""
+    rng = np.random.default_rng(seed)
+    texts = np.array([
+        f"Article {i // 10}\n\n== Section {i % 10} ==\n\n" + " ".join(rng.choice(WORDS, size=words_per_text))
+        for i in range(size)
+    ], dtype=object)
+    embeddings = normalized(rng.normal(size=(size, dim)).astype(np.float32))
+    return KnowledgeBase(texts, embeddings)
+
+
+def synthetic_sections(count: int, words: int, seed: int = 0) -> list[tuple[list[str], str]]:
+    """Returns sections with paragraphs and sentences of random words, long enough to need splitting."""
+    rng = np.random.default_rng(seed)
+    sections = []
+    for i in range(count):
+        sentences = [" ".join(rng.choice(WORDS, size=12)) + "." for _ in range(max(1, words // 12))]
+        paragraphs = [" ".join(sentences[j:j + 5]) for j in range(0, len(sentences), 5)]
+        sections.append(([f"Article {i}", "== History =="], "\n\n".join(paragraphs)))
+    return sections
+
+
+# Stand-ins for the OpenAI clients: embeddings are random unit vectors, the chat answer is fixed
+class StubEmbeddings:
+    def __init__(self, dim: int):
+        self.rng = np.random.default_rng(1)
+        self.dim = dim
+
+    def create(self, model: str, input: list[str]):
+        vectors = normalized(self.rng.normal(size=(len(input), self.dim)))
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=vector.tolist()) for i, vector in enumerate(vectors)],
+            usage=SimpleNamespace(prompt_tokens=len(input)),
+        )
+
+
+class StubCompletions:
+    def create(self, model: str, messages: list[dict], **kwargs):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Manchester United won the treble in 1999."))],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0),
+        )
+
+
+def measure(function, repeat: int, warmup: int = 3, items_per_call: int = 1) -> dict:
+    """Runs the function repeatedly and returns latency percentiles in ms, throughput and peak memory in MB."""
+    for _ in range(warmup):
+        function()
+    latencies = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "throughput_per_s": float(items_per_call * repeat / (latencies.sum() / 1000)),
+        "peak_memory_mb": peak / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of retrieval and prompt assembly")
+    parser.add_argument("--size", type=int, default=20000, help="number of texts in the synthetic knowledge base")
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of the embeddings")
+    parser.add_argument("--words", type=int, default=150, help="words in every knowledge base text")
+    parser.add_argument("--top-n", type=int, default=100, help="number of results of a search")
+    parser.add_argument("--batch", type=int, default=32, help="queries in a batch search")
+    parser.add_argument("--nprobe", type=int, default=8, help="clusters searched by the IVF index")
+    parser.add_argument("--sections", type=int, default=20, help="sections in the chunking benchmark")
+    parser.add_argument("--section-words", type=int, default=3000, help="words in every section to chunk")
+    parser.add_argument("--repeat", type=int, default=50, help="measured calls of every case")
+    parser.add_argument("--only", nargs="+", help="run only these cases")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the p50 latency with")
+    args = parser.parse_args()
+
+    kb = synthetic_knowledge_base(args.size, args.dim, args.words)
+    # Every case gets the synthetic knowledge base explicitly, the bot's own store is never loaded
+    os.environ.setdefault("openai_token", "benchmark")
+    # Answers must not come from the caches, every call goes through the whole pipeline
+    os.environ["answer_cache_size"] = "0"
+    os.environ["embedding_cache_size"] = "0"
+    import query_proc_functions
+    import data_processing_functions
+    query_proc_functions.openai = SimpleNamespace(
+        embeddings=StubEmbeddings(args.dim), chat=SimpleNamespace(completions=StubCompletions())
+    )
+
+    rng = np.random.default_rng(2)
+    query = normalized(rng.normal(size=args.dim))
+    queries = normalized(rng.normal(size=(args.batch, args.dim)))
+    ivf = IVFIndex.build(kb.embeddings, nprobe=args.nprobe)
+    ivf_kb = KnowledgeBase(kb.texts, kb.embeddings)
+    ivf_kb.index = ivf
+    model = query_proc_functions.GPT_MODEL
+    encoding = query_proc_functions.encoding_for(model)
+    token_counts = kb.ensure_token_counts(encoding.name, lambda text: len(encoding.encode(text)))
+    indices, _ = kb.rank(query, top_n=args.top_n)
+    strings = kb.texts[indices].tolist()
+    string_tokens = token_counts[indices].tolist()
+    sections = synthetic_sections(args.sections, args.section_words)
+    lexical = kb.ensure_lexical_index()
+
+    question = "When did Man Utd first win the Premier League?"
+    cases = {
+        "strings_ranked": (lambda: query_proc_functions.strings_ranked_by_relatedness(
+            question, kb=kb, top_n=args.top_n
+        ), 1),
+        "query_message": (lambda: query_proc_functions.query_message(question, kb, model, 4096 - 500), 1),
+        "rank_exact": (lambda: kb.rank(query, top_n=args.top_n), 1),
+        "rank_exact_batch": (lambda: kb.rank(queries, top_n=args.top_n), args.batch),
+        "rank_ivf": (lambda: ivf_kb.rank(query, top_n=args.top_n), 1),
+        "top_k_1": (lambda: kb.rank(query, top_n=1), 1),
+        "bm25_search": (lambda: lexical.search(question, top_n=args.top_n), 1),
+        "rank_hybrid": (lambda: query_proc_functions.ranked_indices(question, query, kb, top_n=args.top_n), 1),
+        "context_selection": (lambda: select_context(indices, kb.texts, kb.embeddings), 1),
+        "pack_precounted": (lambda: query_proc_functions.message_from_strings(
+            question, strings, model, 4096 - 500, string_tokens=string_tokens
+        ), 1),
+        "pack_counting": (lambda: query_proc_functions.message_from_strings(question, strings, model, 4096 - 500), 1),
+        "chunking": (lambda: [
+            data_processing_functions.split_strings_from_subsection(section, max_tokens=1600) for section in sections
+        ], len(sections)),
+        "ask_stubbed": (lambda: query_proc_functions.ask(question, kb=kb), 1),
+    }
+    results = {
+        "config": {**vars(args), "python": platform.python_version(), "numpy": np.__version__},
+        "cases": {},
+    }
+    earlier = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            earlier = json.load(f)["cases"]
+    for name, (function, items_per_call) in cases.items():
+        if args.only and name not in args.only:
+            continue
+        # Chunking is much slower than a search, so it gets fewer calls
+        repeat = max(3, args.repeat // 10) if name == "chunking" else args.repeat
+        results["cases"][name] = measure(function, repeat, items_per_call=items_per_call)
+        case = results["cases"][name]
+        line = (f"{name:18s} p50 {case['p50_ms']:9.3f} ms  p99 {case['p99_ms']:9.3f} ms  "
+                f"{case['throughput_per_s']:10.1f}/s  peak {case['peak_memory_mb']:8.2f} MB")
+        if earlier and name in earlier:
+            line += f"  p50 {case['p50_ms'] / earlier[name]['p50_ms']:.2f}x of before"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
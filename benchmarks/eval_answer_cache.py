@@ -0,0 +1,69 @@
+# Evaluation of the similarity threshold of the answer cache. Every question comes with paraphrases that should get
+# its answer and near misses that must not, e.g. "first" and "last" Premier League title. For every threshold the
+# share of paraphrases served from the cache and the share of near misses wrongly served are reported:
+#   python benchmarks/eval_answer_cache.py --output answer_cache.json
+# Query embeddings come from the OpenAI API, set embedding_cache_path to reuse them between runs
+
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+# The bot modules live one level up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from knowledge_base import normalized
+
+PAIRS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "answer_cache_pairs.json")
+THRESHOLDS = [0.95, 0.96, 0.97, 0.98, 0.985, 0.99, 0.995]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluation of the answer cache threshold on paraphrases and near misses")
+    parser.add_argument("--pairs", default=PAIRS_PATH, help="JSON file with the questions, paraphrases and near misses")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=THRESHOLDS, help="thresholds to evaluate")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    import query_proc_functions
+    with open(args.pairs, encoding="utf-8") as f:
+        pairs = json.load(f)
+
+    paraphrases, near_misses = [], []
+    for item in pairs:
+        embeddings = normalized(np.array(query_proc_functions.query_embeddings(
+            [item["question"]] + item["paraphrases"] + item["near_misses"]
+        ), dtype=np.float32))
+        relatednesses = embeddings[1:] @ embeddings[0]
+        paraphrases.extend(relatednesses[:len(item["paraphrases"])].tolist())
+        near_misses.extend(relatednesses[len(item["paraphrases"]):].tolist())
+        for other, relatedness in zip(item["paraphrases"] + item["near_misses"], relatednesses):
+            print(f"{relatedness:.4f}  {item['question']} | {other}")
+
+    paraphrases, near_misses = np.array(paraphrases), np.array(near_misses)
+    results = {
+        "paraphrases": len(paraphrases),
+        "near_misses": len(near_misses),
+        # A threshold above the closest near miss never gives a wrong answer on these questions
+        "closest_near_miss": float(near_misses.max()),
+        "thresholds": [],
+    }
+    print(f"\n{'threshold':>9} {'paraphrases served':>19} {'near misses served':>19}")
+    for threshold in args.thresholds:
+        row = {
+            "threshold": threshold,
+            "paraphrases_served": float(np.mean(paraphrases >= threshold)),
+            "near_misses_served": float(np.mean(near_misses >= threshold)),
+        }
+        results["thresholds"].append(row)
+        print(f"{threshold:>9} {row['paraphrases_served']:>19.0%} {row['near_misses_served']:>19.0%}")
+    print(f"\nClosest near miss: {results['closest_near_miss']:.4f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Evaluation of the context selection stage on a fixed set of questions with the facts their answers need.
+# Every question is packed into a prompt twice, greedily from the ranking and after context selection, and the
+# prompt tokens and the share of the expected keywords found in the prompt are compared. With --answers both prompts
+# are also sent to chatGPT to compare the completion time and the keywords found in the answers:
+#   python benchmarks/eval_context.py --store "Man United" --output eval.json
+#   python benchmarks/eval_context.py --store "Man United" --answers
+# Query embeddings come from the OpenAI API, set embedding_cache_path to reuse them between runs
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# The bot modules live one level up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from knowledge_base import KnowledgeBase
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_questions.json")
+
+
+def keyword_recall(text: str, keywords: list[list[str]]) -> float:
+    """Returns the share of the expected keywords found in the text, any of the alternatives of a keyword counts."""
+    text = text.lower()
+    found = [any(alternative.lower() in text for alternative in alternatives) for alternatives in keywords]
+    return sum(found) / len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluation of the context selection before prompt packing")
+    parser.add_argument("--store", default="Man United", help="knowledge base store path without extension")
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="JSON file with the questions and their keywords")
+    parser.add_argument("--token-budget", type=int, default=4096 - 500, help="limit on the number of prompt tokens")
+    parser.add_argument("--answers", action="store_true", help="also ask chatGPT and evaluate the answers")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    os.environ["kb_path"] = os.path.abspath(args.store)
+    import query_proc_functions
+    kb = KnowledgeBase.load(args.store)
+    with open(args.questions, encoding="utf-8") as f:
+        questions = json.load(f)
+    model = query_proc_functions.GPT_MODEL
+
+    rows = []
+    for item in questions:
+        question, keywords = item["question"], item["keywords"]
+        query_embedding = query_proc_functions.query_embeddings([question])[0]
+        indices = query_proc_functions.ranked_indices(question, query_embedding, kb)
+        row = {"question": question}
+        for mode, selection in [("greedy", False), ("selected", True)]:
+            message = query_proc_functions.message_from_ranking(
+                question, indices, kb, model=model, token_budget=args.token_budget, selection=selection
+            )
+            row[mode] = {
+                "prompt_tokens": query_proc_functions.num_tokens(message, model=model),
+                "articles": message.count("Wikipedia article section:"),
+                "prompt_recall": keyword_recall(message, keywords),
+            }
+            if args.answers:
+                start = time.perf_counter()
+                response = query_proc_functions.openai.chat.completions.create(
+                    model=model, messages=query_proc_functions.chat_messages(message), temperature=0
+                )
+                row[mode]["completion_seconds"] = time.perf_counter() - start
+                row[mode]["answer_recall"] = keyword_recall(response.choices[0].message.content, keywords)
+        rows.append(row)
+        print(f"{question[:60]:60s} tokens {row['greedy']['prompt_tokens']:5d} -> {row['selected']['prompt_tokens']:5d}  "
+              f"recall {row['greedy']['prompt_recall']:.2f} -> {row['selected']['prompt_recall']:.2f}")
+
+    summary = {
+        mode: {metric: float(np.mean([row[mode][metric] for row in rows])) for metric in rows[0][mode]}
+        for mode in ("greedy", "selected")
+    }
+    for mode, metrics in summary.items():
+        print(f"{mode:9s} " + "  ".join(f"{metric} {value:.3f}" for metric, value in metrics.items()))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "summary": summary, "questions": rows}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Lexical index of the knowledge base. Embeddings are weak at exact names, seasons and scores such as "1999 treble"
+# or "Busby Babes", so the texts are also searched with BM25 over an inverted index and both rankings are fused.
+# A question of rare words that all occur in a best lexical hit well ahead of the others can be answered from the
+# lexical ranking alone, without a request for its embedding
+
+import os
+import re
+from collections import Counter
+import numpy as np
+from vector_index import top_n_sorted
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Words too common to say anything about the relevance of a text
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been before but by can could did do does for from had has have he her
+him his how i in into is it its me my no not of on or our she so than that the their them then there these they this
+to was we were what when where which who whom why will with would you your
+""".split())
+
+
+def tokenize(text: str) -> list[str]:
+    """Returns the lower-case words of the text without stopwords."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+# Reciprocal rank fusion: every ranking adds 1 / (k + rank) to the score of a text, so texts ranked high by
+# either search come first and texts ranked high by both come before them
+def fuse_rankings(
+    rankings: list[np.ndarray], # knowledge base indices of every ranking, best first
+    top_n: int = 100, # select top n results
+    k: int = 60, # damping constant, a larger k gives the lower ranks more weight
+) -> np.ndarray:
+    """Returns the knowledge base indices of the fused ranking, best first."""
+    rankings = [np.asarray(ranking, dtype=np.int64) for ranking in rankings if len(ranking)]
+    if not rankings:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.concatenate(rankings)
+    scores = np.concatenate([1 / (k + 1 + np.arange(len(ranking))) for ranking in rankings])
+    candidates, inverse = np.unique(candidates, return_inverse=True)
+    fused = np.bincount(inverse, weights=scores)
+    indices, _ = top_n_sorted(fused[None, :], candidates[None, :], top_n)
+    return indices[0]
+
+
+class BM25Index:
+    """BM25 over an inverted index: for every term the texts it occurs in with their precomputed term weights."""
+
+    def __init__(
+        self,
+        terms: np.ndarray, # sorted vocabulary
+        postings_offsets: np.ndarray, # postings of term i are postings_docs[postings_offsets[i]:postings_offsets[i + 1]]
+        postings_docs: np.ndarray, # knowledge base indices of the texts every term occurs in
+        postings_weights: np.ndarray, # BM25 term frequency weight of the term in every text of its postings
+        count: int, # number of texts in the knowledge base
+        version: str | None = None, # version of the knowledge base the index was built for
+    ):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        self.postings_offsets = postings_offsets
+        self.postings_docs = postings_docs
+        self.postings_weights = postings_weights
+        self.count = count
+        self.version = version
+        document_frequencies = np.diff(postings_offsets)
+        self.idf = np.log(1 + (count - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+        # A term missing from the knowledge base would be the rarest of all
+        self.missing_idf = float(np.log(1 + (count + 0.5) / 0.5))
+
+    @classmethod
+    def build(
+        cls,
+        texts: np.ndarray, # knowledge base strings
+        k1: float = 1.5, # saturation of the term frequency
+        b: float = 0.75, # how much longer texts are penalized
+        version: str | None = None, # version of the knowledge base, checked when the index is loaded
+    ) -> "BM25Index":
+        """Tokenizes the texts and builds the inverted index."""
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        terms = np.array(sorted({term for c in counts for term in c}), dtype=object)
+        term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        ids = np.array([term_ids[term] for c in counts for term in c], dtype=np.int64)
+        docs = np.repeat(np.arange(len(counts), dtype=np.int32), [len(c) for c in counts])
+        frequencies = np.array([f for c in counts for f in c.values()], dtype=np.float32)
+        # The term frequency part of BM25 depends only on the text, so it is computed once here
+        average_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+        weights = frequencies * (k1 + 1) / (frequencies + k1 * (1 - b + b * lengths[docs] / average_length))
+        order = np.argsort(ids, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(ids, minlength=len(terms)))]).astype(np.int64)
+        return cls(terms, offsets, docs[order], weights[order].astype(np.float32), len(texts), version=version)
+
+    def scores(self, query: str) -> tuple[np.ndarray, np.ndarray, list[str]]:
+        """Returns the texts containing any term of the query, their BM25 scores and the terms of the query."""
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in query_terms:
+            i = self.term_ids.get(term)
+            if i is not None:
+                start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+                scores[self.postings_docs[start:end]] += self.idf[i] * self.postings_weights[start:end]
+        candidates = np.flatnonzero(scores)
+        return candidates, scores[candidates], query_terms
+
+    def search(
+        self,
+        query: str, # custom query
+        top_n: int = 100, # select top n results
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns knowledge base indices and BM25 scores sorted from largest to smallest."""
+        candidates, scores, _ = self.scores(query)
+        indices, scores = top_n_sorted(scores[None, :], candidates[None, :], top_n)
+        return indices[0], scores[0]
+
+    def coverage(self, query_terms: list[str], doc: int) -> float:
+        """Returns the share of the IDF of the query terms that occur in the text, 1.0 if all of them do."""
+        total = matched = 0.0
+        for term in query_terms:
+            i = self.term_ids.get(term)
+            idf = self.missing_idf if i is None else float(self.idf[i])
+            total += idf
+            if i is not None:
+                start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+                # Postings of a term are sorted by text, so the text is found by binary search
+                position = np.searchsorted(self.postings_docs[start:end], doc)
+                if position < end - start and self.postings_docs[start + position] == doc:
+                    matched += idf
+        return matched / total if total else 0.0
+
+    def confident_search(
+        self,
+        query: str, # custom query
+        top_n: int = 100, # select top n results
+        min_terms: int = 2, # minimum number of query terms, a single word is too vague to skip the vector search
+        min_coverage: float = 1.0, # minimum share of the query terms in the best text
+        min_idf: float = 3.0, # minimum IDF of every query term, common words match too many texts to be sure
+        min_margin: float = 1.2, # minimum ratio of the best score to the second best, a close second means a tie
+    ) -> np.ndarray | None:
+        """Returns the lexical ranking if it clearly points at one text, None if the vector search is needed."""
+        candidates, scores, query_terms = self.scores(query)
+        if len(query_terms) < min_terms or not len(candidates):
+            return None
+        for term in query_terms:
+            i = self.term_ids.get(term)
+            if i is not None and self.idf[i] < min_idf:
+                return None
+        indices, top_scores = top_n_sorted(scores[None, :], candidates[None, :], top_n)
+        if len(candidates) > 1 and top_scores[0, 0] < min_margin * top_scores[0, 1]:
+            return None
+        if self.coverage(query_terms, int(indices[0, 0])) < min_coverage:
+            return None
+        return indices[0]
+
+    def save(self, path: str) -> None:
+        """Writes the index to "<path>.bm25.npz" next to the knowledge base."""
+        with open(path + ".bm25.npz.tmp", "wb") as f:
+            np.savez(
+                f,
+                terms=self.terms.astype(str),
+                postings_offsets=self.postings_offsets,
+                postings_docs=self.postings_docs,
+                postings_weights=self.postings_weights,
+                count=self.count,
+                version=self.version or "",
+            )
+        os.replace(path + ".bm25.npz.tmp", path + ".bm25.npz")
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Loads the index written by save()."""
+        with np.load(path + ".bm25.npz") as data:
+            return cls(
+                data["terms"].astype(object),
+                data["postings_offsets"],
+                data["postings_docs"],
+                data["postings_weights"],
+                int(data["count"]),
+                version=str(data["version"]) or None,
+            )
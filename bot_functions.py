@@ -1,12 +1,14 @@
 from typing_extensions import Text
 import logging
-from openai import OpenAI
+import math
 import os
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters.command import Command
-from df import df
-from query_proc_functions import ask
+from df import kb_size
+from request_scheduler import RateLimited, RequestScheduler, SchedulerBusy
+from streaming_reply import StreamingReply
+from metrics import span, trace
 
 # Enable logging so you don't miss important messages
 logging.basicConfig(level=logging.INFO)
@@ -19,7 +21,25 @@ bot = Bot(token=keys)
 # Dispatcher
 dp = Dispatcher()
 
-db_entries = df.shape[0]
+# Stream answers into the reply as they are generated, stream_replies=0 waits for the whole answer instead
+STREAM_REPLIES = os.getenv('stream_replies', '1') == '1'
+# Minimum number of seconds between two edits of a streamed reply, Telegram limits how often a message can be edited
+STREAM_EDIT_INTERVAL = float(os.getenv('stream_edit_interval', 1.0))
+# Questions answered slower than trace_slow_seconds are logged with the time of every stage, also to trace_log_path if set
+TRACE_SLOW_SECONDS = float(os.getenv('trace_slow_seconds')) if os.getenv('trace_slow_seconds') else None
+TRACE_LOG_PATH = os.getenv('trace_log_path')
+
+# Questions go through the scheduler: identical questions in flight share one answer, every user may ask
+# user_burst questions at once and user_rate_per_minute on average, and at most scheduler_queue_size questions
+# wait for one of scheduler_concurrency slots. Questions that do not fit get a busy reply instead of an answer
+scheduler = RequestScheduler(
+    max_concurrent=int(os.getenv('scheduler_concurrency', os.getenv('openai_concurrency', 8))),
+    max_queued=int(os.getenv('scheduler_queue_size', 100)),
+    max_wait=float(os.getenv('scheduler_max_wait', 60)),
+    user_rate=float(os.getenv('user_rate_per_minute', 6)) / 60,
+    user_burst=int(os.getenv('user_burst', 3)),
+)
+BUSY_REPLY = "The bot is answering a lot of questions right now, please try again in a minute."
 
 # Handler for the /start command
 @dp.message(Command("start"))
@@ -34,20 +54,57 @@ async def cmd_start(message: types.Message):
 #help handler
 @dp.message(Command('help'))
 async def cmd_help(message: types.Message):
-    await message.answer(f'This theme of this bot is Manchester United history. \n\nPress /start to restart or initialise the bot. \n/help shows the "help" menu. \n\nThis bot has been trained using data from articles about Manchester United from around the web. There are currently {db_entries} entries in the database \n\nFeel free to ask the bot anything about Man United e.g "When did man utd first win the premier league?"')
+    # The knowledge base can be hot-reloaded, so the number of entries is taken at the time of the command.
+    # It is read from the store header if the knowledge base has not been loaded yet
+    db_entries = kb_size()
+    entries = f'There are currently {db_entries} entries in the database' if db_entries is not None else 'The database is being prepared'
+    await message.answer(f'This theme of this bot is Manchester United history. \n\nPress /start to restart or initialise the bot. \n/help shows the "help" menu. \n\nThis bot has been trained using data from articles about Manchester United from around the web. {entries} \n\nFeel free to ask the bot anything about Man United e.g "When did man utd first win the premier league?"')
 
 #handler for sending and recieving chatgpt messages
 @dp.message()
 async def gpt(message: types.Message):
+    # OpenAI and tiktoken are imported on the first question instead of at startup, usually
+    # main.py has already imported them in the background by then
+    from query_proc_functions import ask_stream_async
     user_id = message.from_user.id
     user_query = message.text
 
-    # Send typing action and temporary message
-    await bot.send_chat_action(message.chat.id, action="typing")
-    temp_message = await message.reply("Please wait while the bot fetches a reply...")
+    with trace(slow_seconds=TRACE_SLOW_SECONDS, log_path=TRACE_LOG_PATH, user_id=user_id, query=user_query):
+        # Questions that are over the limit are turned down before anything is sent to OpenAI
+        try:
+            if STREAM_REPLIES:
+                answer = scheduler.submit(user_id, user_query, ask_stream_async)
+            else:
+                answer = scheduler.submit(user_id, user_query, ask_whole_async)
+        except RateLimited as e:
+            await message.reply(f"You are asking questions too quickly, please wait {math.ceil(e.retry_after)} seconds and ask again.")
+            return
+        except SchedulerBusy:
+            await message.reply(BUSY_REPLY)
+            return
+
+        try:
+            # Send typing action and temporary message
+            with span("telegram_send"):
+                await bot.send_chat_action(message.chat.id, action="typing")
+                temp_message = await message.reply("Please wait while the bot fetches a reply...")
 
-    # Get response from ChatGPT (assuming ask is defined)
-    gpt_response = ask(user_query)
+            # Get response from ChatGPT without blocking the other handlers and show it in the temporary message,
+            # long answers continue in new messages
+            reply = StreamingReply(temp_message, edit_interval=STREAM_EDIT_INTERVAL)
+            try:
+                async for delta in answer:
+                    await reply.feed(delta)
+            except SchedulerBusy:
+                # The question has waited too long in the queue
+                await reply.feed(BUSY_REPLY)
+            await reply.finish()
+        finally:
+            # Identical questions wait for this one, so it is given up properly if anything above fails
+            await answer.aclose()
 
-    # Edit the temporary message with the actual response
-    await temp_message.edit_text(gpt_response)
+# The scheduler expects the answer in pieces, without streaming it comes as one piece
+async def ask_whole_async(query: str):
+    from query_proc_functions import ask_async
+    # chatGPT may return no content, which is an empty piece like an empty stream
+    yield await ask_async(query) or ""
@@ -0,0 +1,65 @@
+# Selection of the knowledge base texts put into the prompt. The ranking often has several overlapping parts of the
+# same article section at the top, which fill the token budget with the same facts. Texts are grouped by the headings
+# that start them, near-duplicates are dropped, every section gets a limited number of texts, and the rest is
+# reordered with maximal marginal relevance (MMR) so that relevant texts that add something new come first.
+# Limiting the number of selected texts keeps the prompt smaller than the token budget
+
+import re
+import numpy as np
+
+# Parts made by split_strings_from_subsection start with the page title and the section headings, separated by blank lines
+HEADING_PATTERN = re.compile(r"^=+[^=].*=+$")
+
+
+def section_key(text: str) -> tuple[str, ...]:
+    """Returns the page title and the headings the text starts with."""
+    parts = text.split("\n\n")
+    key = [parts[0].strip()]
+    for part in parts[1:]:
+        part = part.strip()
+        if not HEADING_PATTERN.match(part):
+            break
+        key.append(part)
+    return tuple(key)
+
+
+def select_context(
+    indices: np.ndarray, # knowledge base indices sorted by relatedness, best first
+    texts: np.ndarray, # knowledge base strings
+    embeddings: np.ndarray, # (len(texts), dim) matrix of normalized embeddings
+    max_per_section: int = 3, # maximum number of texts of one section
+    duplicate_threshold: float = 0.97, # texts at least this similar to a selected one are dropped as near-duplicates
+    mmr_lambda: float = 0.7, # weight of the relevance against the novelty, 1.0 keeps the order of the ranking
+    max_texts: int | None = None, # maximum number of selected texts, None selects until the candidates run out
+) -> np.ndarray:
+    """Returns the selected knowledge base indices in the order they should be put into the prompt."""
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return indices
+    # Rows are read in file order, which is friendlier to a memory-mapped matrix
+    order = np.argsort(indices)
+    candidates = np.empty((len(indices), embeddings.shape[1]), dtype=np.float32)
+    candidates[order] = embeddings[indices[order]]
+    similarities = candidates @ candidates.T
+    # Relevance is taken from the rank, so the selection works the same for vector, lexical and fused rankings.
+    # It falls from 1.0 for the first text to 0.5 for the last
+    relevance = 1 - 0.5 * np.arange(len(indices)) / len(indices)
+    section_ids = {}
+    sections = np.array([section_ids.setdefault(section_key(texts[i]), len(section_ids)) for i in indices])
+    section_counts = np.zeros(len(section_ids), dtype=np.int64)
+    # Similarity of every candidate to the most similar selected text
+    max_similarity = np.full(len(indices), -np.inf, dtype=np.float32)
+    available = np.ones(len(indices), dtype=bool)
+    selected = []
+    while available.any() and (max_texts is None or len(selected) < max_texts):
+        novelty_penalty = np.where(np.isfinite(max_similarity), max_similarity, 0)
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * novelty_penalty, -np.inf)
+        best = int(np.argmax(scores))
+        available[best] = False
+        selected.append(best)
+        section_counts[sections[best]] += 1
+        if section_counts[sections[best]] >= max_per_section:
+            available &= sections != sections[best]
+        max_similarity = np.maximum(max_similarity, similarities[best])
+        available &= max_similarity < duplicate_threshold
+    return indices[selected]
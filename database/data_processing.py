@@ -1,38 +1,46 @@
-import mwclient 
 from openai import OpenAI
+import tiktoken
+import numpy as np
 import pandas as pd # We will store the knowledge base and the result of tokenization of the knowledge base in the DataFrame
 import os
+import sys
 import getpass
 from dotenv import load_dotenv
-from data_processing_functions import WIKI_SITE, CATEGORY_TITLE, titles_from_category, all_subsections_from_title, clean_section, split_strings_from_subsection, keep_section
+# The knowledge base store lives in the bot package one level up, the caches of the build stay in this directory
+DATABASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(DATABASE_DIR))
+from knowledge_base import KnowledgeBase, normalized, store_exists, store_path_from_env, text_hash
+from vector_index import IVFIndex
+from bm25_index import BM25Index
+from embedding_pipeline import embed_strings
+from wiki_crawler import WikiCrawler
+from data_processing_functions import WIKI_SITE, CATEGORY_TITLE, GPT_MODEL, num_tokens, all_subsections_from_text, clean_section, iter_strings_from_sections, keep_section
 
-# Initialize the MediaWiki object
+# The crawler shares one connection pool between its workers and caches wikitext in wiki_cache by revision ID,
+# so a rebuild downloads only the pages edited since the last one
 # WIKI_SITE refers to the English-language part of Wikipedia
-site = mwclient.Site(WIKI_SITE)
+crawler = WikiCrawler(site_name=WIKI_SITE, cache_dir=os.path.join(DATABASE_DIR, "wiki_cache"))
 
-# Load a section of a given category
-category_page = site.pages[CATEGORY_TITLE]
 # Get the set of all category titles with one level of nesting
-titles = titles_from_category(category_page, max_depth=1)
+titles = crawler.titles_from_category(CATEGORY_TITLE, max_depth=1)
 
-# Splitting articles into sections
-# you'll have to wait a bit, as it takes a while to parse almost 2k articles
-wikipedia_sections = []
-for title in titles:
-    wikipedia_sections.extend(all_subsections_from_title(title))
-print(f"{len(wikipedia_sections)} sections have been found on {len(titles)} pages")
+# Splitting articles into sections. Every stage below is a generator, so pages, sections and parts flow through
+# the pipeline one at a time and only the final strings are collected
+wikipedia_sections = (
+    section
+    for title, text in crawler.iter_page_texts(list(titles))
+    for section in all_subsections_from_text(title, text)
+)
 
-# Apply the clean function to all sections using a list generator
-wikipedia_sections = [clean_section(ws) for ws in wikipedia_sections]
+# Apply the clean function to all sections using a generator
+wikipedia_sections = (clean_section(ws) for ws in wikipedia_sections)
 
-original_num_sections = len(wikipedia_sections)
-wikipedia_sections = [ws for ws in wikipedia_sections if keep_section(ws)]
+wikipedia_sections = (ws for ws in wikipedia_sections if keep_section(ws))
 
 # Split sections into parts
 MAX_TOKENS = 1600
-wikipedia_strings = []
-for section in wikipedia_sections:
-     wikipedia_strings.extend(split_strings_from_subsection(section, max_tokens=MAX_TOKENS))
+wikipedia_strings = list(iter_strings_from_sections(wikipedia_sections, max_tokens=MAX_TOKENS))
+print(f"{len(wikipedia_strings)} strings have been made from {len(titles)} pages")
 
 # Now that we have divided our knowledge base into shorter, self-contained lines, we can calculate embeddings for each line.
 
@@ -41,17 +49,44 @@ EMBEDDING_MODEL = "text-embedding-ada-002" # Tokenization model from OpenAI
 load_dotenv()
 OPENAI_API_KEY = os.getenv('openai_token')
 
-client = OpenAI(api_key = OPENAI_API_KEY)
+# openai_base_url lets the build run against a local fake server (fake_embeddings_server.py) instead of the real API.
+# The pipeline retries failed requests itself
+client = OpenAI(api_key = OPENAI_API_KEY, base_url = os.getenv('openai_base_url'), max_retries = 0)
 
-# Function for sending chatGPT string for its tokenization (calculating embeddings)
-def get_embedding(text, model="text-embedding-ada-002"):
-
-    return client.embeddings.create(input = [text], model=model).data[0].embedding
+# The same store as the bot's, kb_path is read from .env like there
+SAVE_PATH = store_path_from_env()
+# A rebuild is incremental when a previous knowledge base exists: chunks are identified by the hash of their text,
+# unchanged chunks keep their embeddings and only new or changed ones are embedded. --full re-embeds everything
+previous_kb = KnowledgeBase.load(SAVE_PATH) if store_exists(SAVE_PATH) else None
+previous_rows = {}
+if previous_kb is not None and "--full" not in sys.argv:
+    previous_rows = {h: row for row, h in enumerate(previous_kb.hashes())}
 
 df = pd.DataFrame({"text": wikipedia_strings})
+df['hash'] = df.text.apply(text_hash)
+changed = ~df.hash.isin(previous_rows)
+print(f"{changed.sum()} of {len(df)} strings are new or changed and need embeddings")
 
-df['embedding'] = df.text.apply(lambda x: get_embedding(x, model='text-embedding-ada-002'))
+# Embed many strings per request with several requests at the same time. Finished batches are saved
+# to the checkpoint directory, so running the script again after an interruption resumes the build
+new_embeddings = iter(normalized(embed_strings(
+    client, df.text[changed].tolist(), model=EMBEDDING_MODEL, checkpoint_dir=os.path.join(DATABASE_DIR, "embedding_checkpoints")
+)))
+embeddings = np.stack([
+    next(new_embeddings) if is_changed else previous_kb.embeddings[previous_rows[h]]
+    for h, is_changed in zip(df.hash, changed)
+])
 
-SAVE_PATH = "./Man United.csv"
-# Save the result
-df.to_csv(SAVE_PATH, index=False)
+# Save the result as the binary store: "Man United.npy" with normalized embeddings and "Man United.json" with texts
+# Token counts of every string are stored with the knowledge base, so the bot never tokenizes it when packing prompts
+token_counts = {tiktoken.encoding_for_model(GPT_MODEL).name: df.text.apply(num_tokens).to_numpy()}
+kb = KnowledgeBase(df.text.to_numpy(dtype=object), embeddings, token_counts)
+# Build the approximate index at ingest, it is saved next to the embeddings as "Man United.ivf.npz"
+kb.index = IVFIndex.build(kb.embeddings)
+# and the BM25 index of the texts for the lexical search, saved as "Man United.bm25.npz"
+kb.lexical = BM25Index.build(kb.texts)
+kb.save(SAVE_PATH)
+if previous_kb is not None:
+    # The running bot hot-loads the delta instead of restarting: added chunks with their embeddings and
+    # tombstones of deleted ones
+    kb.save_delta(SAVE_PATH, base=previous_kb)
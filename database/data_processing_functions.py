@@ -2,6 +2,10 @@ import mwclient # library for working with the MediaWiki API for loading example
 import mwparserfromhell # Parser for MediaWiki
 import openai # will be used for tokenization
 import re # for cutting links <ref> from Wikipedia articles
+import functools # to cache the tokenizer
+from typing import Callable, Iterable, Iterator
+import numpy as np # token offsets of the split sections
+import regex # the pattern tiktoken cuts texts into pieces with
 import tiktoken # to count tokens
 from sections import SECTIONS_TO_IGNORE
 
@@ -93,6 +97,20 @@ def all_subsections_from_title(
 
     # Get the text representation of the page
     text = page.text()
+    return all_subsections_from_text(title, text, sections_to_ignore)
+
+# The function returns a list of all sections of already downloaded page text, except those that are discarded
+def all_subsections_from_text(
+    title: str, # The title of a Wikipedia article
+    text: str, # Wikitext of the article
+    sections_to_ignore: set[str] = SECTIONS_TO_IGNORE, # Sections to ignore
+) -> list[tuple[list[str], str]]:
+    """
+    From the title and wikitext of the Wikipedia page returns a list of all nested sections.
+    Each subsection is a tuple, where:
+      - the first element is a list of parent sections, starting with the page title
+      - the second element represents the section text
+    """
 
     # Convenient parser for MediaWiki
     parsed_text = mwparserfromhell.parse(text)
@@ -131,41 +149,169 @@ def keep_section(section: tuple[list[str], str]) -> bool:
     else:
         return True
     
+# Looking up the encoding is slow, so it is done once per model
+@functools.lru_cache(maxsize=None)
+def encoding_for(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of a model."""
+    return tiktoken.encoding_for_model(model)
+
 # Token counting function
 def num_tokens(text: str, model: str = GPT_MODEL) -> int:
     """Returns the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return len(encoding_for(model).encode(text))
 
-# Line splitting function
-def halved_by_delimiter(string: str, delimiter: str = "\n") -> list[str, str]:
-    """Splits a string in two using a delimiter, attempting to balance the tokens on each side."""
+# Tokenize a text once and remember where every token starts
+def token_starts(text: str, model: str = GPT_MODEL) -> np.ndarray:
+    """Returns the character offset of the start of every token of the text."""
+    encoding = encoding_for(model)
+    _, offsets = encoding.decode_with_offsets(encoding.encode(text))
+    return np.asarray(offsets, dtype=np.int64)
+
+# The encoding first cuts the text into pieces with a regular expression and then merges every piece into tokens
+# on its own, so no token crosses the border of two pieces. tiktoken keeps the expression in a private attribute,
+# without it spans are counted by tokenizing them, which is exact but slower
+@functools.lru_cache(maxsize=None)
+def piece_pattern(model: str) -> regex.Pattern | None:
+    """Returns the compiled regular expression the encoding of the model cuts texts into pieces with, or None."""
+    pattern = getattr(encoding_for(model), "_pat_str", None)
+    return regex.compile(pattern) if isinstance(pattern, str) else None
+
+def piece_starts(text: str, model: str = GPT_MODEL) -> np.ndarray | None:
+    """Returns the character offset of the start of every piece of the text, or None if the pattern is unknown."""
+    pattern = piece_pattern(model)
+    if pattern is None:
+        return None
+    return np.array([match.start() for match in pattern.finditer(text)], dtype=np.int64)
+
+# The regular expression reads at most one character after a piece, or up to the first non-whitespace character
+# after it, so pieces that start up to this point are the same however the text goes on after end
+def stable_point(text: str, end: int) -> int:
+    """Returns the last offset where a piece of text[:end] starts as it does in the whole text."""
+    visible = end
+    while visible > 0 and text[visible - 1].isspace():
+        visible -= 1
+    return min(visible - 1, end - 2)
+
+# Count the tokens of a prefix of a text as if it was tokenized on its own, without tokenizing the whole prefix.
+# The pieces of the prefix are the pieces of the whole text up to its stable point. Only the text after the last
+# piece that starts before that point is tokenized again, which is a few tokens
+def prefix_tokens(
+    text: str, # the whole text
+    end: int, # end of the prefix
+    starts: np.ndarray, # token starts of the whole text
+    pieces: np.ndarray, # piece starts of the whole text
+    model: str = GPT_MODEL, # model
+) -> int:
+    """Returns the number of tokens of text[:end]."""
+    # Last piece the end of the prefix cannot change, the whole prefix is tokenized if there is none
+    piece = np.searchsorted(pieces, stable_point(text, end), side="right") - 1
+    stable = int(pieces[piece]) if piece >= 0 else 0
+    return int(np.searchsorted(starts, stable)) + num_tokens(text[stable:end], model=model)
+
+# Count the tokens of spans of a text, with an optional head like the headings before them, as if every span was
+# tokenized on its own. Pieces cut at the start of a span soon meet a piece start of the whole text again, after
+# which the span has the same tokens as the whole text. So only the head and the first characters of the spans are
+# tokenized, once, and the tokens of a span are a prefix count of the whole text corrected by that difference
+SPAN_WINDOW = 256 # characters at the start of the spans tokenized to find where their pieces meet the whole text
+
+def span_counter(
+    text: str, # the whole text
+    begin: int, # start of the spans
+    starts: np.ndarray, # token starts of the whole text
+    pieces: np.ndarray | None, # piece starts of the whole text, None if the pattern is unknown
+    model: str = GPT_MODEL, # model
+    head: str = "", # text before the spans, e.g. the headings
+) -> Callable[[int], int]:
+    """Returns a function of end giving the number of tokens of head + text[begin:end]."""
+    def tokenized(end: int) -> int:
+        return num_tokens(head + text[begin:end], model=model)
+
+    if pieces is None:
+        return tokenized
+    limit = min(len(text), begin + SPAN_WINDOW)
+    window = head + text[begin:limit]
+    # First piece start of the whole text the window also has a piece start at, before the end of the window can
+    # change its pieces
+    meet = None
+    for match in piece_pattern(model).finditer(window):
+        position = begin + match.start() - len(head)
+        if position > stable_point(text, limit):
+            break
+        piece = np.searchsorted(pieces, position)
+        if position >= begin and piece < len(pieces) and pieces[piece] == position:
+            meet = position
+            break
+    if meet is None:
+        return tokenized
+    correction = num_tokens(window, model=model) - prefix_tokens(text, limit, starts, pieces, model=model)
 
+    def counted(end: int) -> int:
+        if stable_point(text, end) < meet:
+            return tokenized(end) # a span this short ends before its pieces meet the whole text
+        return correction + prefix_tokens(text, end, starts, pieces, model=model)
+
+    return counted
+
+def span_tokens(
+    text: str, # the whole text
+    begin: int, # start of the span
+    end: int, # end of the span
+    starts: np.ndarray, # token starts of the whole text
+    pieces: np.ndarray | None, # piece starts of the whole text, None if the pattern is unknown
+    model: str = GPT_MODEL, # model
+    head: str = "", # text before the span, e.g. the headings
+) -> int:
+    """Returns the number of tokens of head + text[begin:end]."""
+    if end - begin <= SPAN_WINDOW:
+        return num_tokens(head + text[begin:end], model=model)
+    return span_counter(text, begin, starts, pieces, model=model, head=head)(end)
+
+# Find where to split text[begin:end] in two using a delimiter, attempting to balance the tokens on each side
+def halved_span(
+    text: str, # the whole text
+    begin: int, # start of the part to split
+    end: int, # end of the part to split
+    delimiter: str = "\n", # delimiter
+    model: str = GPT_MODEL, # model
+    starts: np.ndarray | None = None, # token starts of the whole text, computed if None
+    pieces: np.ndarray | None = None, # piece starts of the whole text, computed if starts is None
+) -> tuple[tuple[int, int], tuple[int, int]]:
+    """Returns the (begin, end) spans of the left and right halves, an empty span if the delimiter is not found."""
+    part = text[begin:end]
     # Divide the line into parts using the delimiter, by default \n is a line break
-    chunks = string.split(delimiter)
+    chunks = part.split(delimiter)
     if len(chunks) == 1:
-        return [string, ""] # delimiter not found
-    elif len(chunks) == 2:
-        return chunks # no need to look for intermediate point
-    else:
-        # Counting tokens
-        total_tokens = num_tokens(string)
-        halfway = total_tokens // 2
-        # Pre-split in the middle of the number of tokens
-        best_diff = halfway
-        # In the loop we look for which of the delimiters will be closest to best_diff
-        for i, chunk in enumerate(chunks):
-            left = delimiter.join(chunks[: i + 1])
-            left_tokens = num_tokens(left)
-            diff = abs(halfway - left_tokens)
-            if diff >= best_diff:
-                break
-            else:
-                best_diff = diff
-        left = delimiter.join(chunks[:i])
-        right = delimiter.join(chunks[i:])
-        # Return the left and right parts of the optimally divided string
-        return [left, right]
+        return (begin, end), (end, end) # delimiter not found
+    # End of every prefix delimiter.join(chunks[:i + 1]), a running sum of the chunk lengths
+    ends = begin + np.cumsum([len(chunk) + len(delimiter) for chunk in chunks]) - len(delimiter)
+    if len(chunks) == 2:
+        return (begin, int(ends[0])), (int(ends[0]) + len(delimiter), end) # no need to look for intermediate point
+    # Counting tokens, the whole text is tokenized once and every span is counted from it
+    if starts is None:
+        starts, pieces = token_starts(text, model=model), piece_starts(text, model=model)
+    tokens_until = span_counter(text, begin, starts, pieces, model=model)
+    total_tokens = tokens_until(end)
+    halfway = total_tokens // 2
+    # Pre-split in the middle of the number of tokens
+    best_diff = halfway
+    # In the loop we look for which of the delimiters will be closest to best_diff
+    for i, prefix_end in enumerate(ends):
+        left_tokens = tokens_until(int(prefix_end))
+        diff = abs(halfway - left_tokens)
+        if diff >= best_diff:
+            break
+        else:
+            best_diff = diff
+    if i == 0:
+        return (begin, begin), (begin, end)
+    # Return the left and right parts of the optimally divided string
+    return (begin, int(ends[i - 1])), (int(ends[i - 1]) + len(delimiter), end)
+
+# Line splitting function
+def halved_by_delimiter(string: str, delimiter: str = "\n") -> list[str, str]:
+    """Splits a string in two using a delimiter, attempting to balance the tokens on each side."""
+    (left_begin, left_end), (right_begin, right_end) = halved_span(string, 0, len(string), delimiter)
+    return [string[left_begin:left_end], string[right_begin:right_end]]
 
 
 # The function truncates the string to the maximum number of tokens allowed
@@ -176,7 +322,7 @@ def truncated_string(
     print_warning: bool = True, # warning flag
 ) -> str:
     """Trim the string to the maximum number of tokens allowed."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = encoding_for(model)
     encoded_string = encoding.encode(string)
     # Trim the string and decode it back
     truncated_string = encoding.decode(encoded_string[:max_tokens])
@@ -196,36 +342,67 @@ def split_strings_from_subsection(
     Divides sections into a list of sections parts, each part contains no more than max_tokens.
     Each part is a tuple of parent headings [H1, H2, ...] and text (str).
     """
+    return list(iter_strings_from_subsection(subsection, max_tokens=max_tokens, model=model, max_recursion=max_recursion))
+
+# Generator version of split_strings_from_subsection
+def iter_strings_from_subsection(
+    subsection: tuple[list[str], str], # sections
+    max_tokens: int = 1000, # maximum number of tokens
+    model: str = GPT_MODEL, # model
+    max_recursion: int = 5, # maximum number of recursions
+) -> Iterator[str]:
+    """Yields the parts of the section, each part contains no more than max_tokens."""
     titles, text = subsection
-    string = "\n\n".join(titles + [text])
-    num_tokens_in_string = num_tokens(string)
+    # The section is tokenized once, the parts at every level of the recursion are counted from its tokens
+    starts, pieces = token_starts(text, model=model), piece_starts(text, model=model)
+    yield from iter_strings_from_span(titles, text, 0, len(text), max_tokens, model, max_recursion, starts, pieces)
+
+def iter_strings_from_span(
+    titles: list[str], # parent headings
+    text: str, # the whole section text
+    begin: int, # start of the part of the text
+    end: int, # end of the part of the text
+    max_tokens: int, # maximum number of tokens
+    model: str, # model
+    max_recursion: int, # maximum number of recursions
+    starts: np.ndarray, # token starts of the whole section text
+    pieces: np.ndarray | None, # piece starts of the whole section text
+) -> Iterator[str]:
+    """Yields the parts of text[begin:end] with the headings, each part contains no more than max_tokens."""
+    string = "\n\n".join(titles + [text[begin:end]])
     # If the length is valid, it will return a string
-    if num_tokens_in_string <= max_tokens:
-        return [string]
+    head = "".join(title + "\n\n" for title in titles)
+    if span_tokens(text, begin, end, starts, pieces, model=model, head=head) <= max_tokens:
+        yield string
+        return
     # if as a result of the recursion it was not possible to split the string, then we simply truncate it by the number of tokens
-    elif max_recursion == 0:
-        return [truncated_string(string, model=model, max_tokens=max_tokens)]
+    if max_recursion == 0:
+        yield truncated_string(string, model=model, max_tokens=max_tokens)
+        return
     # otherwise we will divide in half and perform recursion
-    else:
-        titles, text = subsection
-        for delimiter in ["\n\n", "\n", "."]: # Trying to use delimiters from largest to smallest (break, paragraph, period)
-            left, right = halved_by_delimiter(text, delimiter=delimiter)
-            if left == "" or right == "":
-                # if either half is empty, try again with a simpler separator
-                continue
-            else:
-                # apply recursion on each half
-                results = []
-                for half in [left, right]:
-                    half_subsection = (titles, half)
-                    half_strings = split_strings_from_subsection(
-                        half_subsection,
-                        max_tokens=max_tokens,
-                        model=model,
-                        max_recursion=max_recursion - 1, # reduce the maximum number of recursions
-                    )
-                    results.extend(half_strings)
-                return results
+    for delimiter in ["\n\n", "\n", "."]: # Trying to use delimiters from largest to smallest (break, paragraph, period)
+        left, right = halved_span(text, begin, end, delimiter=delimiter, model=model, starts=starts, pieces=pieces)
+        if left[0] == left[1] or right[0] == right[1]:
+            # if either half is empty, try again with a simpler separator
+            continue
+        # apply recursion on each half
+        for half_begin, half_end in [left, right]:
+            yield from iter_strings_from_span(
+                titles, text, half_begin, half_end, max_tokens, model,
+                max_recursion - 1, # reduce the maximum number of recursions
+                starts, pieces,
+            )
+        return
     # otherwise no split was found, so just truncate the line (should be very rare)
-    return [truncated_string(string, model=model, max_tokens=max_tokens)]
+    yield truncated_string(string, model=model, max_tokens=max_tokens)
 
+# Streaming chunking stage: sections come in one by one and parts go out one by one,
+# so the whole corpus never has to be held in memory
+def iter_strings_from_sections(
+    sections: Iterable[tuple[list[str], str]], # sections
+    max_tokens: int = 1000, # maximum number of tokens
+    model: str = GPT_MODEL, # model
+) -> Iterator[str]:
+    """Yields the parts of all sections, each part contains no more than max_tokens."""
+    for section in sections:
+        yield from iter_strings_from_subsection(section, max_tokens=max_tokens, model=model)
@@ -0,0 +1,102 @@
+# Batched embedding stage of the database build. Many strings are sent in one request, several requests run
+# at the same time, failed requests are retried with backoff, and every finished batch is saved to a checkpoint
+# directory, so an interrupted build resumes where it stopped instead of embedding everything again
+
+import hashlib
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import openai
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Errors after which the request is worth repeating
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+# Checkpoint files are named after the contents of the batch, so a changed corpus never reuses a stale batch
+def batch_checkpoint_path(checkpoint_dir: str, batch: list[str], model: str) -> str:
+    """Returns the path of the checkpoint file of a batch."""
+    digest = hashlib.sha1(model.encode("utf-8"))
+    for string in batch:
+        digest.update(hashlib.sha1(string.encode("utf-8")).digest())
+    return os.path.join(checkpoint_dir, digest.hexdigest() + ".npy")
+
+
+# Send one batch of strings to OpenAI API, repeating the request with exponential backoff if it fails
+def embed_batch(
+    client: openai.OpenAI, # OpenAI client, may point to a local fake server through base_url
+    batch: list[str], # strings to embed
+    model: str = EMBEDDING_MODEL, # embedding model
+    max_retries: int = 6, # number of retries before giving up
+    backoff: float = 1.0, # delay before the first retry in seconds, doubled after every retry
+) -> np.ndarray:
+    """Returns a (len(batch), dim) matrix with the embeddings of the batch."""
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.embeddings.create(input=batch, model=model)
+            # The API may return the embeddings in any order, so we put them back in the order of the batch
+            data = sorted(response.data, key=lambda x: x.index)
+            return np.array([d.embedding for d in data], dtype=np.float32)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            # Random jitter keeps the parallel requests from retrying all at the same moment
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            print(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f} s")
+            time.sleep(delay)
+
+
+def embed_strings(
+    client: openai.OpenAI, # OpenAI client, may point to a local fake server through base_url
+    strings: list[str], # strings to embed
+    model: str = EMBEDDING_MODEL, # embedding model
+    batch_size: int = 100, # strings per request, 100 chunks of up to 1600 tokens stay under the request limit
+    max_workers: int = 4, # requests running at the same time
+    checkpoint_dir: str | None = None, # directory where finished batches are saved, None disables checkpoints
+    max_retries: int = 6, # number of retries of a failed request
+    backoff: float = 1.0, # delay before the first retry in seconds, doubled after every retry
+) -> np.ndarray:
+    """Returns a (len(strings), dim) matrix with the embeddings of the strings in the same order."""
+    batches = [strings[start:start + batch_size] for start in range(0, len(strings), batch_size)]
+    results = [None] * len(batches)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # Batches embedded before an interruption are read from the checkpoints
+        for i, batch in enumerate(batches):
+            path = batch_checkpoint_path(checkpoint_dir, batch, model)
+            if os.path.exists(path):
+                results[i] = np.load(path)
+        resumed = sum(result is not None for result in results)
+        if resumed:
+            print(f"{resumed} of {len(batches)} batches have been restored from {checkpoint_dir}")
+
+    def embed_and_save(i: int) -> int:
+        embeddings = embed_batch(client, batches[i], model=model, max_retries=max_retries, backoff=backoff)
+        if checkpoint_dir is not None:
+            # Write a temporary file and rename it, so an interruption never leaves a partial checkpoint
+            path = batch_checkpoint_path(checkpoint_dir, batches[i], model)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, embeddings)
+            os.replace(path + ".tmp", path)
+        results[i] = embeddings
+        return i
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(embed_and_save, i) for i in pending]
+        for done, future in enumerate(as_completed(futures), start=1):
+            future.result() # re-raise the error of a batch that failed after all retries
+            if done % 10 == 0 or done == len(futures):
+                print(f"{done} of {len(futures)} batches have been embedded")
+
+    if not batches:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.concatenate(results)
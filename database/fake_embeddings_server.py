@@ -0,0 +1,67 @@
+# Local stand-in for the OpenAI embeddings endpoint, for testing the build pipeline without the real API.
+# Every string gets a deterministic unit vector derived from its hash, and a share of requests can be failed
+# on purpose to exercise retries:
+#   python fake_embeddings_server.py --port 8765 --fail-rate 0.2
+#   openai_base_url=http://localhost:8765/v1 python data_processing.py
+
+import argparse
+import hashlib
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+def fake_embedding(text: str, dim: int) -> list[float]:
+    """Returns a deterministic unit vector for the text."""
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    dim = 1536
+    fail_rate = 0.0
+
+    def do_POST(self):
+        if not self.path.endswith("/embeddings"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if random.random() < self.fail_rate:
+            # 429 is retried by the pipeline like a real rate limit
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}})
+            return
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        self._send_json(200, {
+            "object": "list",
+            "model": request["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(text, self.dim)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    def _send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass # keep the output of the build readable
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI embeddings server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of the embeddings")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 429")
+    args = parser.parse_args()
+    FakeEmbeddingsHandler.dim = args.dim
+    FakeEmbeddingsHandler.fail_rate = args.fail_rate
+    print(f"Fake embeddings server on http://localhost:{args.port}/v1")
+    ThreadingHTTPServer(("localhost", args.port), FakeEmbeddingsHandler).serve_forever()
@@ -0,0 +1,180 @@
+# Concurrent Wikipedia crawler for the database build. One MediaWiki connection pool is shared by all requests,
+# category levels and page texts are fetched by a bounded pool of workers, and raw wikitext is cached on disk
+# by revision ID, so pages that have not been edited since the last build are never downloaded again
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import mwclient
+import requests
+from requests.adapters import HTTPAdapter
+from data_processing_functions import WIKI_SITE
+
+CATEGORY_NAMESPACE = 14 # namespaces of members that are not pages, like mwclient's Category and Image
+FILE_NAMESPACE = 6
+
+
+class WikiCrawler:
+    """Fetches category members and page wikitext from a MediaWiki site."""
+
+    def __init__(
+        self,
+        site=None, # object with a get(action, **kwargs) method like mwclient.Site or RecordedSite, created if None
+        site_name: str = WIKI_SITE, # host of the MediaWiki site
+        cache_dir: str = "./wiki_cache", # directory of the wikitext cache
+        max_workers: int = 8, # requests running at the same time
+        titles_per_request: int = 50, # titles per revision ID request, 50 is the API limit
+        texts_per_request: int = 10, # pages per wikitext request
+        scheme: str = "https", # scheme and path let the crawler talk to a local MediaWiki stand-in
+        path: str = "/w/",
+    ):
+        if site is None:
+            # One session with a connection pool large enough for all workers
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            site = mwclient.Site(site_name, path=path, scheme=scheme, pool=session)
+        self.site = site
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.titles_per_request = titles_per_request
+        self.texts_per_request = texts_per_request
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _map(self, function, items: list) -> list:
+        # Run the requests on a bounded pool of workers and keep the order of the items
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, items))
+
+    def category_members(self, category_title: str) -> list[dict]:
+        """Returns all members of a category as dicts with "ns" and "title", following continuation."""
+        members = []
+        continuation = {}
+        while True:
+            response = self.site.get(
+                "query", list="categorymembers", cmtitle=category_title, cmlimit="max", formatversion=2, **continuation
+            )
+            members.extend(response["query"]["categorymembers"])
+            if "continue" not in response:
+                return members
+            continuation = response["continue"]
+
+    def titles_from_category(
+        self,
+        category_title: str, # title of the category, e.g. "Category:Manchester United F.C."
+        max_depth: int, # Determine the depth of nesting articles
+    ) -> set[str]:
+        """Returns a set of page titles in a given Wikipedia category and its subcategories."""
+        titles = set()
+        visited = {category_title}
+        level = [category_title]
+        # Walk the category tree level by level, the members of all categories of a level are fetched concurrently
+        for depth in range(max_depth, -1, -1):
+            next_level = []
+            for members in self._map(self.category_members, level):
+                for member in members:
+                    if member["ns"] == CATEGORY_NAMESPACE:
+                        if depth > 0 and member["title"] not in visited:
+                            visited.add(member["title"])
+                            next_level.append(member["title"])
+                    elif member["ns"] != FILE_NAMESPACE:
+                        titles.add(member["title"])
+            level = next_level
+        return titles
+
+    def _revision_ids(self, titles: list[str]) -> dict[str, int]:
+        # Current revision IDs of up to titles_per_request pages in one request
+        response = self.site.get("query", prop="revisions", rvprop="ids", titles="|".join(titles), formatversion=2)
+        return {
+            page["title"]: page["revisions"][0]["revid"]
+            for page in response["query"]["pages"]
+            if "revisions" in page # missing pages have no revisions
+        }
+
+    def revision_ids(self, titles: list[str]) -> dict[str, int]:
+        """Returns the current revision ID of every existing page."""
+        batches = [titles[i:i + self.titles_per_request] for i in range(0, len(titles), self.titles_per_request)]
+        revision_ids = {}
+        for batch_ids in self._map(self._revision_ids, batches):
+            revision_ids.update(batch_ids)
+        return revision_ids
+
+    def _cache_path(self, revision_id: int) -> str:
+        return os.path.join(self.cache_dir, f"{revision_id}.wikitext")
+
+    def _fetch_texts(self, revision_ids: list[int]) -> None:
+        # Download the wikitext of the revisions and save it in the cache
+        response = self.site.get(
+            "query", prop="revisions", rvprop="ids|content", rvslots="main",
+            revids="|".join(str(revision_id) for revision_id in revision_ids), formatversion=2,
+        )
+        for page in response["query"]["pages"]:
+            for revision in page.get("revisions", []):
+                path = self._cache_path(revision["revid"])
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(revision["slots"]["main"]["content"])
+                os.replace(path + ".tmp", path)
+
+    def iter_page_texts(self, titles: list[str]) -> Iterator[tuple[str, str]]:
+        """
+        Yields the title and wikitext of every existing page, downloading only revisions missing from the cache.
+        Texts are read from the cache one at a time, so they are never all held in memory.
+        """
+        revision_ids = self.revision_ids(sorted(titles))
+        missing = sorted({
+            revision_id for revision_id in revision_ids.values() if not os.path.exists(self._cache_path(revision_id))
+        })
+        print(f"{len(revision_ids) - len(missing)} of {len(revision_ids)} pages are unchanged and read from {self.cache_dir}")
+        batches = [missing[i:i + self.texts_per_request] for i in range(0, len(missing), self.texts_per_request)]
+        self._map(self._fetch_texts, batches)
+        for title, revision_id in revision_ids.items():
+            with open(self._cache_path(revision_id), encoding="utf-8") as f:
+                yield title, f.read()
+
+    def page_texts(self, titles: list[str]) -> dict[str, str]:
+        """Returns the wikitext of every existing page, downloading only revisions missing from the cache."""
+        return dict(self.iter_page_texts(titles))
+
+
+class RecordingSite:
+    """Wraps a site and records every response, so a crawl can be replayed with RecordedSite."""
+
+    def __init__(self, site, path: str):
+        self.site = site
+        self.path = path
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def get(self, action: str, **kwargs) -> dict:
+        response = self.site.get(action, **kwargs)
+        with self._lock:
+            self.responses[request_key(action, kwargs)] = response
+        return response
+
+    def save(self) -> None:
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.responses, f, ensure_ascii=False)
+
+
+class RecordedSite:
+    """MediaWiki stand-in that replays responses recorded by RecordingSite."""
+
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            self.responses = json.load(f)
+
+    def get(self, action: str, **kwargs) -> dict:
+        key = request_key(action, kwargs)
+        if key not in self.responses:
+            raise KeyError(f"No recorded response for {action} {kwargs}")
+        return self.responses[key]
+
+
+# Requests are identified by their parameters in a fixed order
+def request_key(action: str, kwargs: dict) -> str:
+    """Returns a stable key of a MediaWiki API request."""
+    return hashlib.sha1(json.dumps([action, kwargs], sort_keys=True).encode("utf-8")).hexdigest()
@@ -1,7 +1,114 @@
-import ast
-import pandas as pd
+import asyncio
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from knowledge_base import KnowledgeBase, convert_csv, load_delta, store_exists, store_path_from_env, store_size
+from metrics import Gauge, register_callback
 
-embeddings_path = "https://storage.yandexcloud.net/man-united/Man%20United.csv"
-df = pd.read_csv(embeddings_path)
-# Convert our embeddings from strings to lists
-df['embedding'] = df['embedding'].apply(ast.literal_eval)
+# The modules that read .env import this one first, so kb_path is read from it here
+load_dotenv()
+
+csv_path = "https://storage.yandexcloud.net/man-united/Man%20United.csv"
+# Binary store of the knowledge base: "<store_path>.npy" with embeddings and "<store_path>.json" with texts
+store_path = store_path_from_env()
+
+# The knowledge base is loaded on first use or by a background task at startup, never on import,
+# so the bot starts polling without waiting for it
+kb = None
+delta_mtime = None # modification time of the last delta file that was read
+# Loading, converting and hot-loading deltas replace kb, so they never run at the same time
+_kb_lock = threading.RLock()
+
+KB_READY = Gauge("bot_kb_ready", "Whether the knowledge base has been loaded, 1 or 0")
+KB_LOAD_SECONDS = Gauge("bot_kb_load_seconds", "Time taken by the last full load of the knowledge base")
+KB_ENTRIES = Gauge("bot_kb_entries", "Number of entries in the loaded knowledge base")
+
+
+def load_kb() -> KnowledgeBase:
+    """Loads the knowledge base from the binary store."""
+    # kb_index=ivf searches with the approximate index built at ingest, kb_nprobe trades its speed for recall
+    return KnowledgeBase.load(store_path, index=os.getenv('kb_index', 'exact'), nprobe=int(os.getenv('kb_nprobe', 8)))
+
+
+def ensure_store() -> None:
+    """Makes the binary store if it does not exist yet."""
+    with _kb_lock:
+        if not store_exists(store_path):
+            # One-time conversion of the legacy CSV, later starts only memory-map the store
+            convert_csv(csv_path, store_path, index=os.getenv('kb_index', 'exact'))
+
+
+# The knowledge base can be replaced while the bot is running, so it is always taken through this function
+def current_kb() -> KnowledgeBase:
+    """Returns the knowledge base currently in use, loading it first if needed."""
+    global kb
+    if kb is not None:
+        return kb
+    with _kb_lock:
+        if kb is None:
+            start = time.perf_counter()
+            ensure_store()
+            kb = load_kb()
+            KB_LOAD_SECONDS.set(time.perf_counter() - start)
+            logging.info(f"Knowledge base with {len(kb)} entries has been loaded in {time.perf_counter() - start:.2f} s")
+    return kb
+
+
+async def current_kb_async() -> KnowledgeBase:
+    """Returns the knowledge base currently in use, loading it in an executor so the event loop is not blocked."""
+    if kb is not None:
+        return kb
+    return await asyncio.get_running_loop().run_in_executor(None, current_kb)
+
+
+def kb_ready() -> bool:
+    """Returns True if the knowledge base has been loaded."""
+    return kb is not None
+
+
+def kb_size() -> int | None:
+    """Returns the number of entries without loading the knowledge base, or None if the store has not been made yet."""
+    if kb is not None:
+        return len(kb)
+    if store_exists(store_path):
+        # Only the header of the embedding matrix is read
+        return store_size(store_path)
+    return None
+
+
+def export_kb_stats() -> None:
+    KB_READY.set(1 if kb is not None else 0)
+    if kb is not None:
+        KB_ENTRIES.set(len(kb))
+
+
+register_callback(export_kb_stats)
+
+
+def refresh_kb(
+    reload_store: bool = False, # load the new store instead of applying the delta, keeps the memory-mapped matrix shared between processes
+) -> bool:
+    """Hot-loads the delta written by an incremental rebuild. Returns True if the knowledge base has changed."""
+    global kb, delta_mtime
+    delta_path = store_path + ".delta.json"
+    if kb is None or not os.path.exists(delta_path) or os.path.getmtime(delta_path) == delta_mtime:
+        # Nothing to refresh before the first load, which reads the newest store anyway
+        return False
+    with _kb_lock:
+        delta_mtime = os.path.getmtime(delta_path)
+        delta = load_delta(store_path)
+        if delta["version"] == kb.version:
+            return False
+        if delta["base_version"] == kb.version and not reload_store:
+            try:
+                kb = kb.apply_delta(delta)
+                return True
+            except ValueError as e:
+                # A delta that does not add up to the new store is not trusted
+                logging.warning(f"{e}, loading the whole store instead")
+        # The bot has missed a rebuild, so the delta does not apply and the whole new store is loaded instead.
+        # Applying a delta also copies the matrix into the process, which webhook workers avoid this way
+        kb = load_kb()
+        return True
@@ -0,0 +1,112 @@
+# Cache of query embeddings, so repeated questions don't need a request to OpenAI before the knowledge base is ranked.
+# Recent embeddings are kept in memory, optionally backed by an SQLite file that survives restarts
+
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+# Bring a question to the form used as the cache key
+def normalized_query(text: str) -> str:
+    """Returns the query in lower case with collapsed whitespace and without trailing punctuation."""
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.rstrip("?!.,; ")
+
+
+class EmbeddingCache:
+    """LRU cache of query embeddings with optional expiry and an optional SQLite backing file."""
+
+    def __init__(
+        self,
+        max_size: int = 10000, # maximum number of embeddings kept in memory
+        ttl: float | None = None, # seconds after which an embedding expires, None means never
+        path: str | None = None, # SQLite file for persistent storage, None keeps the cache in memory only
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (time of creation, embedding), the most recently used last
+        # The sync ask runs in threads and the async pipeline on the event loop, so access is serialized with a lock
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL, embedding BLOB)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return f"{model}\n{normalized_query(text)}"
+
+    @property
+    def persistent(self) -> bool:
+        """True if lookups and writes go to the SQLite file, which blocks on disk I/O."""
+        return self._db is not None
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, text: str, model: str) -> np.ndarray | None:
+        """Returns the cached embedding of the query or None."""
+        key = self.key(text, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT created, embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], np.frombuffer(row[1], dtype=np.float32))
+                    self._remember(key, entry)
+            if entry is None or self._expired(entry[0]):
+                if entry is not None:
+                    self._forget(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, text: str, model: str) -> bool:
+        """Returns True if the embedding of the query is cached, without counting a lookup."""
+        key = self.key(text, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                entry = self._db.execute("SELECT created FROM embeddings WHERE key = ?", (key,)).fetchone()
+            return entry is not None and not self._expired(entry[0])
+
+    def put(self, text: str, model: str, embedding: np.ndarray) -> None:
+        """Stores the embedding of the query."""
+        key = self.key(text, model)
+        entry = (time.time(), np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, created, embedding) VALUES (?, ?, ?)",
+                    (key, entry[0], entry[1].tobytes()),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, entry: tuple[float, np.ndarray]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        # Evict the least recently used embeddings, they stay in the SQLite file
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """Returns hit and miss counters and the number of embeddings in memory."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -0,0 +1,323 @@
+# The knowledge base is kept as one contiguous matrix of pre-normalized embeddings with the texts alongside it,
+# so ranking a query is a single matrix-vector product instead of a Python loop over DataFrame rows
+
+import ast
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections import Counter
+import numpy as np
+from vector_index import ExactIndex, IVFIndex
+from bm25_index import BM25Index
+
+# The store is two files next to each other: "<path>.npy" with the embedding matrix, which is memory-mapped on load,
+# and "<path>.json" with the texts and metadata. An incremental rebuild also writes a delta against the previous
+# store: "<path>.delta.npy" with the embeddings of added texts and "<path>.delta.json" with the texts and tombstones
+STORE_FORMAT = 1
+
+
+# Texts are identified by the hash of their contents, so an unchanged chunk keeps its embedding between rebuilds
+def text_hash(text: str) -> str:
+    """Returns the SHA-1 hex digest of the text."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# Fingerprint of the embedding matrix, recorded in the metadata to check that it belongs with the texts
+def embeddings_digest(embeddings: np.ndarray) -> str:
+    """Returns the SHA-1 hex digest of the float32 embedding matrix."""
+    return hashlib.sha1(np.ascontiguousarray(embeddings, dtype=np.float32).data).hexdigest()
+
+
+# Scale every row to unit length, so that the dot product of two rows is their cosine similarity
+def normalized(embeddings: np.ndarray) -> np.ndarray:
+    """Returns a C-contiguous float32 copy of the embeddings with every row scaled to unit length."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1 # leave zero vectors as they are instead of dividing by zero
+    return np.ascontiguousarray(embeddings / norms)
+
+
+class KnowledgeBase:
+    """Texts of the knowledge base together with their unit-length float32 embeddings."""
+
+    def __init__(
+        self,
+        texts: np.ndarray, # array of knowledge base strings
+        embeddings: np.ndarray, # (len(texts), dim) matrix of normalized embeddings
+        token_counts: dict[str, np.ndarray] | None = None, # number of tokens in every text for each tiktoken encoding
+    ):
+        self.texts = texts
+        self.embeddings = embeddings
+        self.token_counts = dict(token_counts or {})
+        self._version = None
+        self._hashes = None
+        # Index the knowledge base is searched with, exact search unless an approximate index is set
+        self.index = ExactIndex(embeddings)
+        # Lexical index of the texts, loaded with the store or built on first use
+        self.lexical = None
+
+    @classmethod
+    def from_dataframe(cls, df) -> "KnowledgeBase":
+        """Builds the knowledge base from a DataFrame with text and embedding columns."""
+        texts = np.asarray(df["text"].tolist(), dtype=object)
+        embeddings = normalized(np.array(df["embedding"].tolist(), dtype=np.float32))
+        return cls(texts, embeddings)
+
+    @classmethod
+    def from_csv(cls, path: str) -> "KnowledgeBase":
+        """Builds the knowledge base from the legacy CSV with embeddings stored as strings (path or URL)."""
+        import pandas as pd # only needed for the one-time conversion
+        df = pd.read_csv(path)
+        # Convert our embeddings from strings to lists
+        df['embedding'] = df['embedding'].apply(ast.literal_eval)
+        return cls.from_dataframe(df)
+
+    @classmethod
+    def load(
+        cls,
+        path: str, # store path without extension
+        mmap: bool = True, # memory-map the embeddings instead of reading them into memory
+        index: str = "exact", # "exact" search or "ivf" approximate search with the index stored next to the embeddings
+        nprobe: int = 8, # number of clusters searched by the ivf index, more gives better recall but slower search
+    ) -> "KnowledgeBase":
+        """Loads the knowledge base from the binary store written by save()."""
+        with open(path + ".json", encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata["format"] != STORE_FORMAT:
+            raise ValueError(f"Unsupported knowledge base format {metadata['format']} in {path}.json")
+        # Read-only memory mapping lets every process on the machine share the same page cache
+        embeddings = np.load(path + ".npy", mmap_mode="r" if mmap else None)
+        texts = np.asarray(metadata["texts"], dtype=object)
+        if embeddings.shape != (len(texts), metadata["dim"]):
+            raise ValueError(f"Embeddings in {path}.npy do not match the texts in {path}.json")
+        # Stores saved before the digest was recorded are only checked by their shape
+        if "embeddings_sha1" in metadata and embeddings_digest(embeddings) != metadata["embeddings_sha1"]:
+            raise ValueError(f"Embeddings in {path}.npy are not the ones recorded in {path}.json, the store is being saved or damaged")
+        token_counts = {
+            encoding: np.asarray(counts, dtype=np.int32) for encoding, counts in metadata.get("token_counts", {}).items()
+        }
+        kb = cls(texts, embeddings, token_counts)
+        kb.version = metadata["version"]
+        if index == IVFIndex.name:
+            if not os.path.exists(path + ".ivf.npz"):
+                # The store was made without the approximate index, e.g. converted from the legacy CSV
+                logging.warning(f"No {IVFIndex.name} index next to {path}, the knowledge base is searched exactly")
+            else:
+                try:
+                    kb.index = IVFIndex.load(path, embeddings, nprobe=nprobe, version=kb.version)
+                except ValueError as e:
+                    # An index left over from an older store, or the new one of a store that is being saved
+                    logging.warning(f"{e}, the knowledge base is searched exactly")
+        elif index != ExactIndex.name:
+            raise ValueError(f"Unknown index {index}, expected {ExactIndex.name} or {IVFIndex.name}")
+        if os.path.exists(path + ".bm25.npz"):
+            lexical = BM25Index.load(path)
+            # A lexical index left over from an older store is ignored and built again when needed
+            if lexical.version == kb.version and lexical.count == len(kb):
+                kb.lexical = lexical
+        return kb
+
+    def save(self, path: str) -> None:
+        """Writes the knowledge base to the binary store, replacing the files atomically."""
+        embeddings = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        metadata = {
+            "format": STORE_FORMAT,
+            "version": self.version,
+            "count": len(self),
+            "dim": embeddings.shape[1],
+            "embeddings_sha1": embeddings_digest(embeddings),
+            "texts": self.texts.tolist(),
+            "token_counts": {encoding: counts.tolist() for encoding, counts in self.token_counts.items()},
+        }
+        # Write temporary files and rename them, so a running bot that mapped the old files keeps reading them.
+        # The JSON file is replaced last: until then a load finds the old texts with the new embeddings or indexes,
+        # which the recorded digest and the versions of the indexes reveal
+        with open(path + ".npy.tmp", "wb") as f:
+            np.save(f, embeddings)
+        os.replace(path + ".npy.tmp", path + ".npy")
+        self.index.save(path, version=self.version)
+        if self.lexical is not None:
+            self.lexical.version = self.version
+            self.lexical.save(path)
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    @property
+    def version(self) -> str:
+        """Fingerprint of the contents, changes whenever the knowledge base is rebuilt."""
+        if self._version is None:
+            digest = hashlib.sha1()
+            for text in self.texts:
+                digest.update(text.encode("utf-8"))
+            digest.update(np.ascontiguousarray(self.embeddings).tobytes())
+            self._version = digest.hexdigest()
+        return self._version
+
+    @version.setter
+    def version(self, value: str) -> None:
+        self._version = value
+
+    def hashes(self) -> np.ndarray:
+        """Returns the hash of every text."""
+        if self._hashes is None:
+            self._hashes = np.array([text_hash(text) for text in self.texts], dtype=object)
+        return self._hashes
+
+    def save_delta(
+        self,
+        path: str, # store path without extension
+        base: "KnowledgeBase", # previous knowledge base the running bot has loaded
+    ) -> None:
+        """Writes the changes from the base knowledge base to this one as a delta the bot can hot-load."""
+        # Texts are compared as multisets, the same text can occur more than once, e.g. in two articles
+        base_counts = Counter(base.hashes())
+        counts = Counter(self.hashes())
+        seen = Counter()
+        added = np.zeros(len(self), dtype=bool)
+        for i, h in enumerate(self.hashes()):
+            seen[h] += 1
+            # Occurrences beyond the ones the base already has are added
+            added[i] = seen[h] > base_counts[h]
+        delta = {
+            "format": STORE_FORMAT,
+            "base_version": base.version,
+            "version": self.version,
+            "count": len(self),
+            # Tombstones of the texts that are no longer in the knowledge base, one per removed occurrence
+            "removed": sorted((base_counts - counts).elements()),
+            "texts": self.texts[added].tolist(),
+            "token_counts": {encoding: counts[added].tolist() for encoding, counts in self.token_counts.items()},
+        }
+        # The embeddings are written first, the bot only reads a delta once its JSON file is in place
+        with open(path + ".delta.npy.tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self.embeddings[added], dtype=np.float32))
+        os.replace(path + ".delta.npy.tmp", path + ".delta.npy")
+        with open(path + ".delta.json.tmp", "w", encoding="utf-8") as f:
+            json.dump(delta, f, ensure_ascii=False)
+        os.replace(path + ".delta.json.tmp", path + ".delta.json")
+
+    def apply_delta(self, delta: dict) -> "KnowledgeBase":
+        """Returns a new knowledge base with the delta written by save_delta() applied to this one."""
+        if delta["base_version"] != self.version:
+            raise ValueError(f"Delta is based on version {delta['base_version']}, not on {self.version}")
+        removed = Counter(delta["removed"])
+        kept = np.ones(len(self), dtype=bool)
+        for i, h in enumerate(self.hashes()):
+            if removed[h]:
+                removed[h] -= 1
+                kept[i] = False
+        texts = np.concatenate([self.texts[kept], np.asarray(delta["texts"], dtype=object)])
+        embeddings = np.concatenate([np.asarray(self.embeddings[kept]), delta["embeddings"]])
+        # Token counts survive only for the encodings the delta has counts for
+        token_counts = {
+            encoding: np.concatenate([self.token_counts[encoding][kept], np.asarray(counts, dtype=np.int32)])
+            for encoding, counts in delta["token_counts"].items()
+            if encoding in self.token_counts
+        }
+        if len(texts) != delta.get("count", len(texts)):
+            raise ValueError(f"Delta gives {len(texts)} entries instead of the {delta['count']} of version {delta['version']}")
+        kb = KnowledgeBase(texts, embeddings, token_counts)
+        kb.version = delta["version"]
+        if isinstance(self.index, IVFIndex):
+            # Keep the clusters of the approximate index and only reassign the embeddings to them
+            kb.index = IVFIndex.from_centroids(embeddings, self.index.centroids, nprobe=self.index.nprobe)
+        if self.lexical is not None:
+            kb.lexical = BM25Index.build(texts, version=kb.version)
+        return kb
+
+    def ensure_token_counts(
+        self,
+        encoding: str, # name of the tiktoken encoding
+        num_tokens, # function returning the number of tokens in a string for this encoding
+    ) -> np.ndarray:
+        """Returns the number of tokens in every text, counting them once if the store has no counts for the encoding."""
+        counts = self.token_counts.get(encoding)
+        if counts is None:
+            counts = np.array([num_tokens(text) for text in self.texts], dtype=np.int32)
+            self.token_counts[encoding] = counts
+        return counts
+
+    def ensure_lexical_index(self) -> BM25Index:
+        """Returns the lexical index of the texts, building it once if the store has none."""
+        if self.lexical is None:
+            self.lexical = BM25Index.build(self.texts, version=self.version)
+        return self.lexical
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def rank(
+        self,
+        query_embeddings: np.ndarray, # (dim,) vector or (n_queries, dim) matrix of query embeddings
+        top_n: int = 100, # select top n results
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns indices and relatednesses of the top n rows for every query, sorted from largest to smallest.
+        Both arrays have shape (n_queries, top_n); a single query vector gives arrays of shape (top_n,).
+        """
+        queries = normalized(np.atleast_2d(query_embeddings))
+        indices, relatednesses = self.index.search(queries, top_n)
+        if np.ndim(query_embeddings) == 1:
+            return indices[0], relatednesses[0]
+        return indices, relatednesses
+
+# Read the delta written by an incremental rebuild
+def load_delta(path: str) -> dict | None:
+    """Returns the delta with its "embeddings" matrix, or None if there is no delta next to the store."""
+    if not os.path.exists(path + ".delta.json"):
+        return None
+    with open(path + ".delta.json", encoding="utf-8") as f:
+        delta = json.load(f)
+    delta["embeddings"] = np.load(path + ".delta.npy")
+    if len(delta["embeddings"]) != len(delta["texts"]):
+        raise ValueError(f"Embeddings in {path}.delta.npy do not match the texts in {path}.delta.json")
+    return delta
+
+
+# Check whether both files of the binary store are present
+def store_exists(path: str) -> bool:
+    """Returns True if the binary store exists at the given path."""
+    return os.path.exists(path + ".npy") and os.path.exists(path + ".json")
+
+
+# The embedding matrix is memory-mapped, so its shape is known from the .npy header without reading the store
+def store_size(path: str) -> int:
+    """Returns the number of entries in the binary store."""
+    return np.load(path + ".npy", mmap_mode="r").shape[0]
+
+
+# The bot and the database build, which runs in the database directory, find the store through kb_path. A relative
+# path is taken from the bot package and not from the working directory, so both always use the same files
+def store_path_from_env() -> str:
+    """Returns the store path without extension given by the kb_path environment variable."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv('kb_path', 'Man United'))
+
+
+# One-time conversion of the legacy CSV into the binary store
+def convert_csv(
+    csv_path: str, # path or URL of the CSV with text and embedding columns
+    store_path: str, # store path without extension
+    model: str = "gpt-3.5-turbo", # model whose tokenizer is used to count tokens of the texts
+    index: str = "exact", # "ivf" also builds the approximate index, like an ingest does
+) -> "KnowledgeBase":
+    """Converts the CSV knowledge base into the binary store and returns it."""
+    import tiktoken
+    kb = KnowledgeBase.from_csv(csv_path)
+    # Count tokens of every text once, so the bot packs prompts without tokenizing the knowledge base
+    encoding = tiktoken.encoding_for_model(model)
+    kb.ensure_token_counts(encoding.name, lambda text: len(encoding.encode(text)))
+    if index == IVFIndex.name:
+        kb.index = IVFIndex.build(kb.embeddings)
+    kb.ensure_lexical_index()
+    kb.save(store_path)
+    return kb
+
+
+# One-time converter from the legacy CSV: python knowledge_base.py "Man United.csv" "Man United"
+if __name__ == "__main__":
+    csv_path, store_path = sys.argv[1], sys.argv[2]
+    kb = convert_csv(csv_path, store_path)
+    print(f"{len(kb)} entries have been converted from {csv_path} to {store_path}.npy and {store_path}.json")
@@ -1,9 +1,80 @@
+import time
+# Taken before the other imports, so the measured time to the first poll includes them
+STARTED = time.monotonic()
 import asyncio
+import functools
+import logging
+import os
 from bot_functions import dp, bot
+from df import current_kb, kb_ready, refresh_kb
+from metrics import Gauge, start_metrics_server
+
+# How often to check for a delta written by an incremental rebuild of the knowledge base, in seconds
+KB_RELOAD_INTERVAL = int(os.getenv('kb_reload_interval', 60))
+# Local endpoint with Prometheus metrics of the answer path, off unless metrics_port is set. Webhook workers serve
+# theirs on the next ports, so pick a free range, e.g. 9464 and up, away from exporters like node_exporter on 9100
+METRICS_HOST = os.getenv('metrics_host', '127.0.0.1')
+METRICS_PORT = int(os.getenv('metrics_port', 0))
+# Load the knowledge base in the background right after startup, kb_preload=0 loads it on the first question instead
+KB_PRELOAD = os.getenv('kb_preload', '1') == '1'
+# "polling" runs the bot in this process, "webhook" receives updates on a local server and answers them
+# in a pool of worker processes (see webhook_server.py)
+BOT_MODE = os.getenv('bot_mode', 'polling')
+
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Time from the start of the process to the start of polling")
+
+# Hot-load knowledge base deltas without restarting the bot
+async def reload_knowledge_base(reload_store: bool = False):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(KB_RELOAD_INTERVAL)
+        try:
+            # Applying a delta builds new arrays, so it runs in an executor to keep the bot responsive
+            if await loop.run_in_executor(None, refresh_kb, reload_store):
+                logging.info("Knowledge base has been reloaded")
+        except Exception:
+            logging.exception("Knowledge base reload failed")
+
+# Import the answering pipeline and load the knowledge base while the bot is already polling
+def warm_up():
+    import query_proc_functions
+    if KB_PRELOAD:
+        current_kb()
+
+async def preload():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+    except Exception:
+        # The first question retries the load
+        logging.exception("Knowledge base preload failed")
+
+# Called by the dispatcher right before the first request for updates
+async def on_startup():
+    STARTUP_SECONDS.set(time.monotonic() - STARTED)
+    logging.info(f"Polling started {time.monotonic() - STARTED:.2f} s after the start of the process")
 
 # Starting the polling process for new updates
 async def main():
+    reload_task = asyncio.create_task(reload_knowledge_base())
+    preload_task = asyncio.create_task(preload())
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, ready=kb_ready)
+    dp.startup.register(on_startup)
     await dp.start_polling(bot)
+    reload_task.cancel()
+    preload_task.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
 
 if __name__ == "__main__":
- asyncio.run(main()) 
\ No newline at end of file
+ if BOT_MODE == "webhook":
+  from webhook_server import run_webhook
+  # Workers reload the whole memory-mapped store after a rebuild instead of applying the delta, so they keep sharing it
+  run_webhook(
+   background=(functools.partial(reload_knowledge_base, reload_store=True), preload),
+   metrics_host=METRICS_HOST,
+   metrics_port=METRICS_PORT,
+  )
+ else:
+  asyncio.run(main())
@@ -0,0 +1,210 @@
+# Latency and usage metrics of the answer path. Every stage of answering a question is timed with span(),
+# token and cost counters are kept per model, and everything is exported in the Prometheus text format
+# on a local HTTP endpoint. A trace of the stages of every request can be logged for slow questions
+
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+# Upper bounds of the latency buckets in seconds, from a cached lookup to a long chat completion
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Price in dollars per 1000 tokens of every model, (prompt, completion)
+PRICES_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+_registry = []
+_callbacks = []
+_lock = threading.Lock()
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Value that only grows, e.g. the number of tokens sent to a model."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down, e.g. the number of entries in a cache."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, e.g. the latency of a stage."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {} # labels -> [count of every bucket, sum, count]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            bucket_counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self.values[key] = (bucket_counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, (bucket_counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Time spent in every stage of answering a question")
+REQUEST_SECONDS = Histogram("bot_request_seconds", "Time from receiving a question to the complete answer")
+TOKENS = Counter("bot_tokens_total", "Tokens sent to and received from OpenAI models")
+COST = Counter("bot_cost_dollars_total", "Estimated cost of the OpenAI requests in dollars")
+
+
+def register_callback(callback) -> None:
+    """Registers a function that updates gauges right before the metrics are exported."""
+    _callbacks.append(callback)
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text format."""
+    for callback in _callbacks:
+        callback()
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def record_usage(model: str, prompt_tokens: int, completion_tokens: int = 0) -> None:
+    """Counts the tokens of an OpenAI request and its estimated cost."""
+    TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    if completion_tokens:
+        TOKENS.inc(completion_tokens, model=model, kind="completion")
+    prompt_price, completion_price = PRICES_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    COST.inc((prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000, model=model)
+
+
+# Trace of the request being answered, every span adds its stage and duration to it
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+trace_logger = logging.getLogger("trace")
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Records the duration of a stage measured elsewhere, e.g. the time to the first token."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    current = _current_trace.get()
+    if current is not None:
+        current["spans"].append({"stage": stage, "seconds": round(seconds, 6)})
+
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block as a stage of the answer path."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace(
+    slow_seconds: float | None = None, # requests slower than this are logged with all their spans, None disables it
+    log_path: str | None = None, # file the slow traces are appended to as JSON lines, besides the log
+    **attributes, # details of the request written with the trace, e.g. the question
+):
+    """Times a whole request and collects the spans of its stages."""
+    current = {"spans": [], **attributes}
+    token = _current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current["seconds"] = round(time.perf_counter() - start, 6)
+        REQUEST_SECONDS.observe(current["seconds"])
+        if slow_seconds is not None and current["seconds"] >= slow_seconds:
+            line = json.dumps(current, ensure_ascii=False, default=str)
+            trace_logger.warning("Slow request: %s", line)
+            if log_path is not None:
+                with open(log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+
+def in_current_context(function):
+    """Wraps a function so that it runs in the current context, keeping the trace in executor threads."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+async def start_metrics_server(
+    host: str,
+    port: int,
+    ready=None, # function returning True once the bot can answer questions, served on /health
+) -> web.AppRunner | None:
+    """Starts serving the metrics on http://host:port/metrics and returns the runner to stop it, None if it failed."""
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    # Readiness probe: 200 when ready, 503 while the bot is still loading
+    async def handle_health(request: web.Request) -> web.Response:
+        if ready is None or ready():
+            return web.Response(text="ok")
+        return web.Response(text="loading", status=503)
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Metrics are not worth stopping the bot for, e.g. when another exporter has taken the port
+        logging.error(f"Metrics cannot be served on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return runner
@@ -1,13 +1,22 @@
-# Now we will create a search function that tokenises and compares the user querry to the dataframe and
-# returns top n texts ranked by relevance based on their cosine distance to the dataframe embeddings
+# Now we will create a search function that tokenises and compares the user querry to the knowledge base and
+# returns top n texts ranked by relevance based on their cosine similarity to the knowledge base embeddings
 
-from scipy import spatial # calculates vector similarity
-import pandas as pd
-from openai import OpenAI
+import asyncio
+import functools
+import time
+from typing import AsyncIterator, Generator
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
 import tiktoken
 import os
 from dotenv import load_dotenv
-from df import df
+from df import current_kb, current_kb_async
+from knowledge_base import KnowledgeBase
+from bm25_index import fuse_rankings
+from context_selection import select_context
+from embedding_cache import EmbeddingCache
+from answer_cache import AnswerCache
+from metrics import Counter, Gauge, in_current_context, observe_stage, record_usage, register_callback, span
 
 load_dotenv()
 OPEN_AI_TOKEN = os.getenv('openai_token')
@@ -15,98 +24,494 @@ OPEN_AI_TOKEN = os.getenv('openai_token')
 openai = OpenAI(
   api_key = OPEN_AI_TOKEN,
 )
+# Async client for the bot handlers, so waiting for OpenAI does not block the event loop
+async_openai = AsyncOpenAI(
+  api_key = OPEN_AI_TOKEN,
+)
+
+# Limit on the number of requests to OpenAI in flight at the same time, the rest wait for a free slot
+MAX_CONCURRENT_REQUESTS = int(os.getenv('openai_concurrency', 8))
+openai_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
 GPT_MODEL = "gpt-3.5-turbo" 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 
+# Cache of query embeddings, popular questions skip the request to OpenAI. Set embedding_cache_path to keep it between restarts
+embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv('embedding_cache_size', 10000)),
+    ttl=float(os.getenv('embedding_cache_ttl')) if os.getenv('embedding_cache_ttl') else None,
+    path=os.getenv('embedding_cache_path'),
+)
+
+# Cache of answers, a question asked before gets its answer. Setting answer_cache_threshold also gives it to questions
+# within that cosine similarity of an answered one; it is off by default, as near misses like "first" and "last"
+# league title are very close. Check a threshold with benchmarks/eval_answer_cache.py before setting it, e.g. 0.99
+answer_cache = AnswerCache(
+    threshold=float(os.getenv('answer_cache_threshold')) if os.getenv('answer_cache_threshold') else None,
+    max_size=int(os.getenv('answer_cache_size', 1000)),
+)
+
+# Hits and misses of the caches are exported with the other metrics
+CACHE_LOOKUPS = Gauge("bot_cache_lookups", "Hits and misses of the embedding and answer caches")
+
+def export_cache_stats() -> None:
+    for name, cache in [("embedding", embedding_cache), ("answer", answer_cache)]:
+        stats = cache.stats()
+        CACHE_LOOKUPS.set(stats["hits"], cache=name, result="hit")
+        CACHE_LOOKUPS.set(stats["misses"], cache=name, result="miss")
+
+register_callback(export_cache_stats)
+
+# hybrid_search=1 fuses the BM25 ranking of the question's words with the vector ranking. lexical_fast_path=1 answers
+# a question of at least lexical_min_terms words without requesting its embedding when every word has an IDF of at
+# least lexical_min_idf, all of them occur in the best lexical hit and it scores lexical_min_margin times the second
+HYBRID_SEARCH = os.getenv('hybrid_search', '1') == '1'
+LEXICAL_FAST_PATH = os.getenv('lexical_fast_path', '0') == '1'
+LEXICAL_MIN_TERMS = int(os.getenv('lexical_min_terms', 2))
+LEXICAL_MIN_IDF = float(os.getenv('lexical_min_idf', 3.0))
+LEXICAL_MIN_MARGIN = float(os.getenv('lexical_min_margin', 1.2))
+# context_selection=1 drops near-duplicate texts (context_duplicate_threshold), keeps at most context_max_per_section
+# texts of one article section and reorders the ranking with MMR (context_mmr_lambda) before the prompt is packed.
+# At most context_max_texts texts are packed, 0 fills the whole token budget
+CONTEXT_SELECTION = os.getenv('context_selection', '1') == '1'
+CONTEXT_MAX_PER_SECTION = int(os.getenv('context_max_per_section', 3))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv('context_duplicate_threshold', 0.97))
+CONTEXT_MMR_LAMBDA = float(os.getenv('context_mmr_lambda', 0.7))
+CONTEXT_MAX_TEXTS = int(os.getenv('context_max_texts', 12))
+LEXICAL_ANSWERS = Counter("bot_lexical_fast_path_total", "Questions answered from the lexical ranking without an embedding")
+
+# Send a list of queries to OpenAI API for tokenization in a single request
+def query_embeddings(
+    queries: list[str], # custom queries
+) -> np.ndarray:
+    """Returns a (len(queries), dim) matrix with the embeddings of the queries"""
+    embeddings = [embedding_cache.get(query, EMBEDDING_MODEL) for query in queries]
+    missing = [query for query, embedding in zip(queries, embeddings) if embedding is None]
+    if missing:
+        with span("embedding"):
+            query_embedding_response = openai.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=missing,
+            )
+        record_usage(EMBEDDING_MODEL, query_embedding_response.usage.prompt_tokens)
+        embeddings = cached_embeddings(queries, embeddings, query_embedding_response.data)
+    return np.array(embeddings, dtype=np.float32)
+
+# Fill the embeddings missing from the cache with the ones received from OpenAI and remember them
+def cached_embeddings(
+    queries: list[str], # custom queries
+    embeddings: list[np.ndarray | None], # embeddings found in the cache, None for the missing ones
+    data: list, # embeddings of the missing queries returned by OpenAI API
+) -> list[np.ndarray]:
+    """Returns the embeddings of all queries."""
+    # The API may return the embeddings in any order, so we put them back in the order of the queries
+    received = iter(sorted(data, key=lambda x: x.index))
+    embeddings = list(embeddings)
+    for i, query in enumerate(queries):
+        if embeddings[i] is None:
+            embeddings[i] = np.array(next(received).embedding, dtype=np.float32)
+            embedding_cache.put(query, EMBEDDING_MODEL, embeddings[i])
+    return embeddings
+
 # Search function
 def strings_ranked_by_relatedness(
     query: str, # custom query
-    df: pd.DataFrame, # DataFrame with text and embedding columns (knowledge base)
-    relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y), # relatedness function, cosine distance
+    kb: KnowledgeBase | None = None, # knowledge base with texts and normalized embeddings, the current one if None
     top_n: int = 100 # select top n results
 ) -> tuple[list[str], list[float]]: # Function returns a tuple of two lists, first contains strings, second contains floats
     """Returns strings and relatednesses sorted from largest to smallest"""
+    return strings_ranked_by_relatedness_batch([query], kb, top_n=top_n)[0]
 
-    # Send custom query to OpenAI API for tokenization
-    query_embedding_response = openai.embeddings.create(
-    model=EMBEDDING_MODEL,
-    input=query,
-    )
-
-    # Received tokenized user query
-    query_embedding = query_embedding_response.data[0].embedding
-
-    # Compare user query with each tokenized row of DataFrame
-    strings_and_relatednesses = [
-        (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-        for i, row in df.iterrows()
+# Batch search function, all queries are tokenized in one request and ranked with one matrix product
+def strings_ranked_by_relatedness_batch(
+    queries: list[str], # custom queries
+    kb: KnowledgeBase | None = None, # knowledge base with texts and normalized embeddings, the current one if None
+    top_n: int = 100 # select top n results
+) -> list[tuple[list[str], list[float]]]:
+    """Returns strings and relatednesses sorted from largest to smallest for every query"""
+    if kb is None:
+        kb = current_kb()
+    # Vector ranking only, the answer pipeline fuses it with the lexical ranking in ranked_indices
+    embeddings = query_embeddings(queries)
+    indices, relatednesses = kb.rank(embeddings, top_n=top_n)
+    return [
+        (kb.texts[query_indices].tolist(), query_relatednesses.tolist())
+        for query_indices, query_relatednesses in zip(indices, relatednesses)
     ]
 
-    # Sort the resulting list by descending similarity
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-
-    # Transform our list into a tuple of lists
-    strings, relatednesses = zip(*strings_and_relatednesses)
+# Async version of query_embeddings for the bot handlers
+async def query_embeddings_async(
+    queries: list[str], # custom queries
+) -> np.ndarray:
+    """Returns a (len(queries), dim) matrix with the embeddings of the queries"""
+    embeddings = await run_cache_io(lambda: [embedding_cache.get(query, EMBEDDING_MODEL) for query in queries])
+    missing = [query for query, embedding in zip(queries, embeddings) if embedding is None]
+    if missing:
+        async with openai_semaphore:
+            with span("embedding"):
+                query_embedding_response = await async_openai.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=missing,
+                )
+        record_usage(EMBEDDING_MODEL, query_embedding_response.usage.prompt_tokens)
+        embeddings = await run_cache_io(functools.partial(cached_embeddings, queries, embeddings, query_embedding_response.data))
+    return np.array(embeddings, dtype=np.float32)
 
-    # Return the top n results
-    return strings[:top_n], relatednesses[:top_n]
+# Lookups and writes of an embedding cache backed by SQLite wait for the disk, so the async pipeline runs them in an
+# executor. The in-memory cache is fast enough to be used on the event loop
+async def run_cache_io(function):
+    """Returns the result of the function, called in an executor if the embedding cache is persistent."""
+    if not embedding_cache.persistent:
+        return function()
+    return await asyncio.get_running_loop().run_in_executor(None, function)
 
 # Now we create an ask function that can accept a user querry, search our database for relevant articles, insert this knowledge
 # as a message to chaGPT, send chatGPT a message and recieve a response
 
+# Template instructions for chatGPT
+INTRODUCTION = '''Use the below articles about Manchester United F.C to answer the subsequent question. If the answer cannot be found in the articles, give an alternate reply from your knowledge base. If there's stiil no answer, write "I'm sorry, I can only answer questions about Manchester United"'''
+#write "I could not find an answer."'
+# Template of a knowledge base article inside the message
+ARTICLE_TEMPLATE = '\n\nWikipedia article section:\n"""\n{}\n"""'
+
+# Looking up the encoding is slow, so it is done once per model
+@functools.lru_cache(maxsize=None)
+def encoding_for(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of a model"""
+    return tiktoken.encoding_for_model(model)
+
 def num_tokens(text: str, model: str = GPT_MODEL) -> int:
     """Returns the number of tokens in a string for a given model"""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return len(encoding_for(model).encode(text))
+
+# Tokens the article template adds around every knowledge base string
+@functools.lru_cache(maxsize=None)
+def article_overhead(model: str) -> int:
+    """Returns the number of tokens in the article template without the string"""
+    return num_tokens(ARTICLE_TEMPLATE.format(""), model=model)
 
 # Function for generating a request to chatGPT based on a user question and knowledge base
 def query_message(
     query: str, # custom query
-    df: pd.DataFrame, # DataFrame with text and embedding columns (knowledge base)
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    model: str, # model
+    token_budget: int # limit on the number of tokens sent to the model
+) -> str:
+    """Returns a message for GPT with the corresponding source texts extracted from the knowledge base."""
+    # Ranked, deduplicated and packed the same way as the questions answered by ask()
+    query_embedding = query_embeddings([query])[0]
+    return message_from_embedding(query, query_embedding, kb, model=model, token_budget=token_budget)
+
+# Function for generating a request to chatGPT from an already tokenized user question, it only uses CPU,
+# so the async pipeline runs it in an executor
+def message_from_embedding(
+    query: str, # custom query
+    query_embedding: np.ndarray, # tokenized custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
     model: str, # model
     token_budget: int # limit on the number of tokens sent to the model
 ) -> str:
-    """Returns a message for GPT with the corresponding source texts extracted from the data frame (knowledge base)."""
-    strings, relatednesses = strings_ranked_by_relatedness(query, df) # function for ranking the knowledge base by user query
-    # Template instructions for chatGPT
-    message = '''Use the below articles about Manchester United F.C to answer the subsequent question. If the answer cannot be found in the articles, give an alternate reply from your knowledge base. If there's stiil no answer, write "I'm sorry, I can only answer questions about Manchester United"'''
-    #write "I could not find an answer."'
+    """Returns a message for GPT with the source texts most related to the query embedding."""
+    indices = ranked_indices(query, query_embedding, kb)
+    return message_from_ranking(query, indices, kb, model=model, token_budget=token_budget)
+
+# Rank the knowledge base by the query embedding, fused with the lexical ranking of the query when hybrid search is on
+def ranked_indices(
+    query: str, # custom query
+    query_embedding: np.ndarray, # tokenized custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    top_n: int = 100 # select top n results
+) -> np.ndarray:
+    """Returns knowledge base indices sorted from the most related to the least."""
+    with span("ranking"):
+        indices, _ = kb.rank(query_embedding, top_n=top_n)
+    if not HYBRID_SEARCH:
+        return indices
+    with span("lexical_ranking"):
+        lexical_indices, _ = kb.ensure_lexical_index().search(query, top_n=top_n)
+        return fuse_rankings([indices, lexical_indices], top_n=top_n)
+
+# Questions of rare words that clearly point at one text are answered without the embedding request
+def lexical_fast_path(
+    query: str, # custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+) -> np.ndarray | None:
+    """Returns the lexical ranking if it is confident enough to skip the embedding, None if the embedding is needed."""
+    # A cached embedding costs nothing and gives the vector ranking, so such questions take the usual path
+    if not LEXICAL_FAST_PATH or embedding_cache.contains(query, EMBEDDING_MODEL):
+        return None
+    with span("lexical_ranking"):
+        indices = kb.ensure_lexical_index().confident_search(
+            query, min_terms=LEXICAL_MIN_TERMS, min_idf=LEXICAL_MIN_IDF, min_margin=LEXICAL_MIN_MARGIN
+        )
+    if indices is not None:
+        LEXICAL_ANSWERS.inc()
+    return indices
+
+# Pack the knowledge base texts of a ranking into a message for chatGPT
+def message_from_ranking(
+    query: str, # custom query
+    indices: np.ndarray, # knowledge base indices sorted by relatedness
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    model: str, # model
+    token_budget: int, # limit on the number of tokens sent to the model
+    selection: bool | None = None, # deduplicate and rerank the texts before packing, context_selection if None
+) -> str:
+    """Returns a message for GPT with as many of the ranked texts as fit into the token budget."""
+    if CONTEXT_SELECTION if selection is None else selection:
+        with span("context_selection"):
+            indices = select_context(
+                indices, kb.texts, kb.embeddings,
+                max_per_section=CONTEXT_MAX_PER_SECTION,
+                duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD,
+                mmr_lambda=CONTEXT_MMR_LAMBDA,
+                max_texts=CONTEXT_MAX_TEXTS or None,
+            )
+    # Token counts are stored with the knowledge base, so packing the message needs no tokenization of the articles
+    encoding = encoding_for(model)
+    token_counts = kb.ensure_token_counts(encoding.name, lambda text: len(encoding.encode(text)))
+    with span("prompt_packing"):
+        return message_from_strings(
+            query, kb.texts[indices].tolist(), model=model, token_budget=token_budget, string_tokens=token_counts[indices].tolist()
+        )
+
+# Function for packing ranked knowledge base strings into a message for chatGPT
+def message_from_strings(
+    query: str, # custom query
+    strings: list[str], # knowledge base strings sorted by relatedness
+    model: str, # model
+    token_budget: int, # limit on the number of tokens sent to the model
+    string_tokens: list[int] | None = None, # number of tokens in every string, counted here if not given
+) -> str:
+    """Returns a message for GPT with as many of the strings as fit into the token budget."""
+    if string_tokens is None:
+        string_tokens = [num_tokens(string, model=model) for string in strings]
     # Question Template
     question = f"\n\nQuestion: {query}"
 
-    # Add relevant lines from the knowledge base to the message for chatGPT until we exceed the allowed number of tokens
-    for string in strings:
-        next_article = f'\n\nWikipedia article section:\n"""\n{string}\n"""'
-        if (num_tokens(message + next_article + question, model=model) > token_budget):
+    # Add relevant lines from the knowledge base to the message for chatGPT until we exceed the allowed number of tokens.
+    # Tokens are summed up per article instead of encoding the whole growing message for every candidate
+    total_tokens = num_tokens(INTRODUCTION, model=model) + num_tokens(question, model=model)
+    articles = []
+    for string, tokens in zip(strings, string_tokens):
+        article_tokens = article_overhead(model) + tokens
+        if total_tokens + article_tokens > token_budget:
             break
-        else:
-            message += next_article
-    return message + question
+        total_tokens += article_tokens
+        articles.append(ARTICLE_TEMPLATE.format(string))
+    message = INTRODUCTION + "".join(articles) + question
+    # Tokens can merge across article borders, so the sum may be slightly off. Check the final message once
+    # and drop the last articles in the rare case it is over the budget
+    while articles and num_tokens(message, model=model) > token_budget:
+        articles.pop()
+        message = INTRODUCTION + "".join(articles) + question
+    return message
+
+# Messages sent to chatGPT for a prepared message
+def chat_messages(message: str) -> list[dict]:
+    """Returns the chat history for a message with the question and the knowledge base articles."""
+    return [
+        {"role": "system", "content": "You answer questions about Manchester United F.C."},
+        {"role": "user", "content": message},
+    ]
+
+# Answers are cached by the question itself, and by its embedding if it was ranked with one
+def remember_answer(
+    query: str, # custom query
+    query_embedding: np.ndarray | None, # tokenized custom query, None if it was ranked lexically
+    model: str, # model
+    kb_version: str, # version of the knowledge base the answer came from
+    answer: str | None, # answer of chatGPT, None if it has returned no content
+) -> None:
+    """Stores the answer in the answer cache."""
+    # An empty answer is not worth repeating, the question is sent to chatGPT again next time
+    if not answer or not answer.strip():
+        return
+    answer_cache.put_query(query, model, kb_version, answer)
+    if query_embedding is not None:
+        answer_cache.put(query_embedding, model, kb_version, answer)
+
+
+# The steps before the request to chatGPT, shared by ask, ask_async and ask_stream_async. The generator yields the
+# query when it needs its embedding and is sent the embedding back, so each caller requests it in its own way
+def question_steps(
+    query: str, # custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    model: str, # model
+    token_budget: int, # limit on the number of tokens sent to the model
+) -> Generator[str, np.ndarray, tuple[str | None, str | None, np.ndarray | None]]:
+    """Returns the cached answer or the message for chatGPT, and the query embedding if it was needed."""
+    # The same question asked again gets the cached answer without a request to chatGPT
+    cached_answer = answer_cache.get_query(query, model, kb.version)
+    if cached_answer is not None:
+        return cached_answer, None, None
+    # Questions with a confident lexical hit are ranked without an embedding
+    lexical_indices = lexical_fast_path(query, kb)
+    if lexical_indices is not None:
+        return None, message_from_ranking(query, lexical_indices, kb, model=model, token_budget=token_budget), None
+    query_embedding = yield query
+    # With a similarity threshold, near-duplicate questions get the cached answer too
+    cached_answer = answer_cache.get(query_embedding, model, kb.version)
+    if cached_answer is not None:
+        return cached_answer, None, query_embedding
+    # Form a message to chatGPT (function above)
+    return None, message_from_embedding(query, query_embedding, kb, model=model, token_budget=token_budget), query_embedding
+
+# Steps are resumed through this function, so the end of the generator is a value and not a StopIteration,
+# which can't be passed through a future of an executor
+def advance(
+    steps: Generator, # steps of question_steps
+    value: np.ndarray | None = None, # embedding of the query that the steps have asked for, None to start them
+) -> tuple[bool, object]:
+    """Returns (True, result) if the steps are done, or (False, query) if they need the embedding of the query."""
+    try:
+        return False, steps.send(value)
+    except StopIteration as done:
+        return True, done.value
+
+
+def prepare_question(
+    query: str, # custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    model: str, # model
+    token_budget: int, # limit on the number of tokens sent to the model
+) -> tuple[str | None, str | None, np.ndarray | None]:
+    """Runs the question steps with the sync OpenAI client."""
+    steps = question_steps(query, kb, model, token_budget)
+    done, value = advance(steps)
+    while not done:
+        done, value = advance(steps, query_embeddings([value])[0])
+    return value
+
+
+async def prepare_question_async(
+    query: str, # custom query
+    kb: KnowledgeBase, # knowledge base with texts and normalized embeddings
+    model: str, # model
+    token_budget: int, # limit on the number of tokens sent to the model
+) -> tuple[str | None, str | None, np.ndarray | None]:
+    """Runs the question steps with the async OpenAI client and the ranking in an executor."""
+    loop = asyncio.get_running_loop()
+    steps = question_steps(query, kb, model, token_budget)
+    if LEXICAL_FAST_PATH:
+        done, value = await loop.run_in_executor(None, in_current_context(functools.partial(advance, steps)))
+    else:
+        # Without the lexical fast path the first step only asks for the embedding, so it is not worth an executor
+        done, value = advance(steps)
+    while not done:
+        query_embedding = (await query_embeddings_async([value]))[0]
+        done, value = await loop.run_in_executor(None, in_current_context(functools.partial(advance, steps, query_embedding)))
+    return value
 
 
 def ask(
     query: str, # custom query
-    df: pd.DataFrame = df, # DataFrame with text and embedding columns (knowledge base)
+    kb: KnowledgeBase | None = None, # knowledge base with texts and normalized embeddings, the current one if None
     model: str = GPT_MODEL, # model
     token_budget: int = 4096 - 500, # limit on the number of tokens sent to the model
     print_message: bool = False, # whether to print the message before sending
 ) -> str:
     """Answers the question using GPT and the knowledge base."""
-    # Form a message to chatGPT (function above)
-    message = query_message(query, df, model=model, token_budget=token_budget)
+    if kb is None:
+        kb = current_kb()
+    cached_answer, message, query_embedding = prepare_question(query, kb, model, token_budget)
+    if cached_answer is not None:
+        return cached_answer
     # If the parameter is True, output the message
     if print_message:
         print(message)
-    messages = [
-        {"role": "system", "content": "You answer questions about Manchester United F.C."},
-        {"role": "user", "content": message},
-    ]
-    response = openai.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0 # hyperparameter for the degree of randomness when generating text. Affects how the model selects the next word in the sequence.
-    )
+    with span("chat_completion"):
+        response = openai.chat.completions.create(
+            model=model,
+            messages=chat_messages(message),
+            temperature=0 # hyperparameter for the degree of randomness when generating text. Affects how the model selects the next word in the sequence.
+        )
+    record_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+    response_message = response.choices[0].message.content
+    remember_answer(query, query_embedding, model, kb.version, response_message)
+    return response_message
+
+# Async version of ask for the bot handlers: OpenAI requests are awaited with a limit on concurrency
+# and ranking runs in an executor, so other users are not blocked while one question is answered
+async def ask_async(
+    query: str, # custom query
+    kb: KnowledgeBase | None = None, # knowledge base with texts and normalized embeddings, the current one if None
+    model: str = GPT_MODEL, # model
+    token_budget: int = 4096 - 500, # limit on the number of tokens sent to the model
+) -> str:
+    """Answers the question using GPT and the knowledge base without blocking the event loop."""
+    if kb is None:
+        kb = await current_kb_async()
+    cached_answer, message, query_embedding = await prepare_question_async(query, kb, model, token_budget)
+    if cached_answer is not None:
+        return cached_answer
+    async with openai_semaphore:
+        with span("chat_completion"):
+            response = await async_openai.chat.completions.create(
+                model=model,
+                messages=chat_messages(message),
+                temperature=0
+            )
+    record_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
     response_message = response.choices[0].message.content
+    remember_answer(query, query_embedding, model, kb.version, response_message)
     return response_message
 
+# Streaming version of ask_async: the answer is yielded piece by piece as chatGPT generates it,
+# so the bot can show the first words without waiting for the whole answer
+async def ask_stream_async(
+    query: str, # custom query
+    kb: KnowledgeBase | None = None, # knowledge base with texts and normalized embeddings, the current one if None
+    model: str = GPT_MODEL, # model
+    token_budget: int = 4096 - 500, # limit on the number of tokens sent to the model
+) -> AsyncIterator[str]:
+    """Yields the answer to the question in pieces as they are generated."""
+    if kb is None:
+        kb = await current_kb_async()
+    cached_answer, message, query_embedding = await prepare_question_async(query, kb, model, token_budget)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    # The answer is read from OpenAI into a queue by a separate task, so the OpenAI slot is released and the
+    # chat_completion stage ends as soon as chatGPT is done, not when the caller has shown every piece in Telegram
+    deltas = asyncio.Queue()
+
+    async def read_completion():
+        try:
+            async with openai_semaphore:
+                with span("chat_completion"):
+                    start = time.perf_counter()
+                    stream = await async_openai.chat.completions.create(
+                        model=model,
+                        messages=chat_messages(message),
+                        temperature=0,
+                        stream=True,
+                        stream_options={"include_usage": True}, # the last chunk carries the token usage
+                    )
+                    first = True
+                    async for chunk in stream:
+                        if chunk.usage is not None:
+                            record_usage(model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first:
+                                observe_stage("first_token", time.perf_counter() - start)
+                                first = False
+                            deltas.put_nowait(chunk.choices[0].delta.content)
+        finally:
+            deltas.put_nowait(None) # end of the answer, also after an error
+
+    reader = asyncio.create_task(read_completion())
+    pieces = []
+    try:
+        while True:
+            piece = await deltas.get()
+            if piece is None:
+                break
+            pieces.append(piece)
+            yield piece
+        # Raises the error of the request if it has failed
+        await reader
+    finally:
+        # The caller may stop reading early, then the request is cancelled
+        reader.cancel()
+    remember_answer(query, query_embedding, model, kb.version, "".join(pieces))
@@ -0,0 +1,212 @@
+# Scheduler in front of the answer pipeline. Identical questions asked while one is being answered share its answer,
+# every user has a token bucket limiting how fast they can ask, and questions waiting for a free slot are served
+# round-robin between users from a bounded queue, so one user cannot starve the others. When the queue is full or
+# a question waits too long the request is shed and the user is told that the bot is busy
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Callable
+from embedding_cache import normalized_query
+from metrics import Counter, Gauge, register_callback
+
+REQUESTS = Counter("bot_scheduler_requests_total", "Questions received by the scheduler by their outcome")
+QUEUED = Gauge("bot_scheduler_queued", "Questions waiting for a free slot")
+ACTIVE = Gauge("bot_scheduler_active", "Questions being answered")
+
+
+class RateLimited(Exception):
+    """The user has asked too many questions in a short time."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f} s")
+        self.retry_after = retry_after
+
+
+class SchedulerBusy(Exception):
+    """The queue of questions is full or the question has waited too long for a free slot."""
+
+
+class AnswerStream:
+    """Pieces of the answer of an admitted question. Closing the stream before reading it gives up the question."""
+
+    def __init__(self, pieces: AsyncIterator[str], abandon: Callable[[], None] | None = None):
+        self._pieces = pieces
+        self._abandon = abandon
+        self._started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        self._started = True
+        return await self._pieces.__anext__()
+
+    async def aclose(self) -> None:
+        # A generator that has not started does not run its cleanup when closed, so it is done here
+        if not self._started and self._abandon is not None:
+            self._abandon()
+        await self._pieces.aclose()
+
+
+class TokenBuckets:
+    """Token bucket of every user: a question takes a token, tokens refill at a constant rate up to the burst size."""
+
+    def __init__(
+        self,
+        rate: float, # tokens added per second
+        burst: int, # maximum number of tokens, i.e. questions that can be asked at once
+        max_users: int = 10000, # full buckets are dropped when more users than this are tracked
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = {} # user -> (tokens, monotonic time of the last update)
+
+    def take(self, user) -> None:
+        """Takes a token of the user, raises RateLimited if there is none."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[user] = (tokens, now)
+            raise RateLimited((1 - tokens) / self.rate)
+        self._buckets[user] = (tokens - 1, now)
+        if len(self._buckets) > self.max_users:
+            # A bucket that has refilled is the same as no bucket at all
+            self._buckets = {
+                user: (tokens, updated) for user, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * self.rate < self.burst
+            }
+
+
+class RequestScheduler:
+    """Coalesces, rate-limits and fairly queues the questions sent to the answer pipeline."""
+
+    def __init__(
+        self,
+        max_concurrent: int = 8, # questions answered at the same time, the others wait in the queue
+        max_queued: int = 100, # questions allowed to wait, more are shed with SchedulerBusy
+        max_wait: float = 60.0, # seconds a question may wait for a free slot before it is shed
+        user_rate: float = 0.1, # questions per second every user can ask on average
+        user_burst: int = 3, # questions a user can ask in quick succession
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.buckets = TokenBuckets(user_rate, user_burst)
+        self._active = 0
+        self._queued = 0
+        self._waiters = OrderedDict() # user -> deque of futures waiting for a slot, users are served in turn
+        self._in_flight = {} # normalized question -> future with the answer of the request answering it
+        register_callback(self.export_stats)
+
+    def submit(
+        self,
+        user, # id of the user asking, limits and fairness are per user
+        query: str, # custom query
+        run: Callable[[str], AsyncIterator[str]], # answer pipeline, yields the answer in pieces
+    ) -> AnswerStream:
+        """
+        Admits the question and returns the stream of its answer, which must be closed when no longer needed.
+        Raises RateLimited or SchedulerBusy right away, so the user can be told before any work is done.
+        """
+        try:
+            self.buckets.take(user)
+        except RateLimited:
+            REQUESTS.inc(outcome="rate_limited")
+            raise
+        key = normalized_query(query)
+        if key in self._in_flight:
+            REQUESTS.inc(outcome="coalesced")
+            return AnswerStream(self._follow(self._in_flight[key]))
+        if self._active >= self.max_concurrent and self._queued >= self.max_queued:
+            REQUESTS.inc(outcome="busy")
+            raise SchedulerBusy("The queue of questions is full")
+        # Registered now, so an identical question arriving before the stream starts is coalesced too
+        flight = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = flight
+        return AnswerStream(self._lead(user, key, flight, query, run), lambda: self._end_flight(key, flight))
+
+    async def _follow(self, flight: asyncio.Future) -> AsyncIterator[str]:
+        # Identical question in flight, wait for its whole answer instead of asking again
+        yield await asyncio.shield(flight)
+
+    async def _lead(self, user, key: str, flight: asyncio.Future, query: str, run) -> AsyncIterator[str]:
+        pieces = []
+        try:
+            await self._acquire(user)
+            try:
+                async for piece in run(query):
+                    pieces.append(piece)
+                    yield piece
+            finally:
+                self._release()
+            REQUESTS.inc(outcome="answered")
+            flight.set_result("".join(pieces))
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            self._end_flight(key, flight)
+
+    def _end_flight(self, key: str, flight: asyncio.Future) -> None:
+        if not flight.done():
+            # The leader has been cancelled or closed before finishing, the followers ask again later
+            flight.set_exception(SchedulerBusy("The question was abandoned"))
+        # Mark the error as retrieved, otherwise asyncio logs it when no question has followed this one
+        flight.exception()
+        if self._in_flight.get(key) is flight:
+            del self._in_flight[key]
+
+    async def _acquire(self, user) -> None:
+        # Take a slot, waiting in the queue of the user if all are in use
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        if self._queued >= self.max_queued:
+            REQUESTS.inc(outcome="busy")
+            raise SchedulerBusy("The queue of questions is full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(waiter)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # The slot was handed over at the last moment, give it to the next question
+                self._release()
+            else:
+                waiter.cancel()
+                self._forget(user, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                REQUESTS.inc(outcome="busy")
+                raise SchedulerBusy("The question has waited too long for a free slot") from None
+            raise
+
+    def _forget(self, user, waiter: asyncio.Future) -> None:
+        waiters = self._waiters.get(user)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del self._waiters[user]
+
+    def _release(self) -> None:
+        # Hand the slot to the first waiting question of the next user in turn, or free it
+        while self._waiters:
+            user, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._waiters.move_to_end(user)
+            else:
+                del self._waiters[user]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def export_stats(self) -> None:
+        QUEUED.set(self._queued)
+        ACTIVE.set(self._active)
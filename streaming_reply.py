@@ -0,0 +1,96 @@
+# Progressive delivery of a streamed answer to Telegram. The placeholder message is edited as text arrives,
+# edits are coalesced so there is at most one per edit interval, and an answer longer than the Telegram
+# message limit continues in new messages
+
+import asyncio
+import logging
+import time
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from metrics import span
+
+TELEGRAM_MESSAGE_LIMIT = 4096 # maximum number of characters in one Telegram message
+# Shown instead of the placeholder when the answer is empty, Telegram does not accept empty messages
+EMPTY_ANSWER = "Sorry, no answer was generated. Please ask again."
+
+
+# Cut a long text into messages, preferring to break at a line break or a space
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Returns the non-blank parts of the text, each no longer than the limit."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit # no good place to break, cut in the middle of a word
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    parts.append(text)
+    # Telegram rejects messages without visible text, e.g. whitespace left after the last cut
+    return [part for part in parts if part.strip()]
+
+
+class StreamingReply:
+    """Shows a growing answer in the placeholder message and the messages that follow it."""
+
+    def __init__(
+        self,
+        placeholder: types.Message, # message that is replaced with the answer
+        edit_interval: float = 1.0, # minimum number of seconds between two updates
+        limit: int = TELEGRAM_MESSAGE_LIMIT, # maximum number of characters in one message
+    ):
+        self.messages = [placeholder]
+        self.shown = [placeholder.text] # text currently displayed in every message
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ""
+        self.last_update = 0.0 # monotonic time of the last update
+        self.blocked_until = 0.0 # Telegram asked to wait with updates until this time
+
+    async def feed(self, delta: str) -> None:
+        """Adds a piece of the answer, the messages are updated if the edit interval has passed."""
+        self.text += delta
+        now = time.monotonic()
+        if now - self.last_update >= self.edit_interval and now >= self.blocked_until:
+            await self._update()
+
+    async def finish(self) -> None:
+        """Shows the whole answer, waiting out any flood limits."""
+        if not self.text.strip():
+            # Nothing to show, the placeholder must not be left waiting forever
+            self.text = EMPTY_ANSWER
+        while True:
+            delay = self.blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self._update():
+                return
+
+    async def _update(self) -> bool:
+        # Bring the messages in line with the text, returns False if Telegram asked to slow down
+        self.last_update = time.monotonic()
+        if not self.text.strip():
+            return True # Telegram does not accept empty messages
+        parts = split_message(self.text, self.limit)
+        try:
+            for i, part in enumerate(parts):
+                if i < len(self.messages):
+                    if self.shown[i] != part:
+                        with span("telegram_edit"):
+                            await self.messages[i].edit_text(part)
+                        self.shown[i] = part
+                else:
+                    # The answer has outgrown the last message, continue it in a new one
+                    with span("telegram_send"):
+                        self.messages.append(await self.messages[-1].answer(part))
+                    self.shown.append(part)
+        except TelegramRetryAfter as e:
+            self.blocked_until = time.monotonic() + e.retry_after
+            return False
+        except TelegramBadRequest as e:
+            # Raised when the text has not changed since the last edit, which is harmless
+            if "message is not modified" not in str(e):
+                raise
+            logging.debug("Skipped an edit that did not change the message")
+        return True
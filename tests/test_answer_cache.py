@@ -0,0 +1,69 @@
+# Lookups of the answer cache with its default settings and with a similarity threshold. Real embeddings of
+# paraphrases and near misses are compared by benchmarks/eval_answer_cache.py, here they are placed at a chosen
+# cosine similarity of the question:
+#   python -m pytest tests
+
+import os
+import sys
+import numpy as np
+import pytest
+
+# The bot modules live one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from answer_cache import AnswerCache
+
+MODEL = "gpt-3.5-turbo"
+VERSION = "v1"
+DIM = 64
+
+
+def at_similarity(embedding: np.ndarray, relatedness: float, seed: int = 0) -> np.ndarray:
+    """Returns a unit vector with the given cosine similarity to the unit embedding."""
+    rng = np.random.default_rng(seed)
+    other = rng.normal(size=embedding.shape)
+    other -= (other @ embedding) * embedding
+    other /= np.linalg.norm(other)
+    return relatedness * embedding + np.sqrt(1 - relatedness ** 2) * other
+
+
+@pytest.fixture
+def question() -> np.ndarray:
+    embedding = np.random.default_rng(1).normal(size=DIM)
+    return embedding / np.linalg.norm(embedding)
+
+
+def test_default_answers_only_the_same_question(question):
+    cache = AnswerCache()
+    cache.put_query("When did Manchester United first win the Premier League?", MODEL, VERSION, "In 1993.")
+    cache.put(question, MODEL, VERSION, "In 1993.")
+    assert cache.get_query("when did manchester united first win the premier league", MODEL, VERSION) == "In 1993."
+    assert cache.get_query("When did Manchester United last win the Premier League?", MODEL, VERSION) is None
+    # "first" and "last" title are close by the embedding, without a threshold they never share an answer
+    assert cache.get(at_similarity(question, 0.98), MODEL, VERSION) is None
+    assert cache.get(question, MODEL, VERSION) is None
+
+
+@pytest.mark.parametrize("relatedness, shared", [(0.995, True), (0.99, True), (0.985, False), (0.97, False)])
+def test_threshold_shares_answers_of_close_questions(question, relatedness, shared):
+    cache = AnswerCache(threshold=0.99)
+    cache.put(question, MODEL, VERSION, "In 1993.")
+    answer = cache.get(at_similarity(question, relatedness), MODEL, VERSION)
+    assert (answer == "In 1993.") if shared else (answer is None)
+
+
+def test_answers_of_another_model_or_knowledge_base_are_not_shared(question):
+    cache = AnswerCache(threshold=0.99)
+    cache.put(question, MODEL, VERSION, "In 1993.")
+    cache.put_query("Who owns the club?", MODEL, VERSION, "The Glazers.")
+    assert cache.get(question, "gpt-4", VERSION) is None
+    assert cache.get_query("Who owns the club?", MODEL, "v2") is None
+    # A new version of the knowledge base drops all answers
+    assert cache.get(question, MODEL, VERSION) is None
+
+
+def test_zero_size_caches_nothing(question):
+    cache = AnswerCache(threshold=0.99, max_size=0)
+    cache.put(question, MODEL, VERSION, "In 1993.")
+    cache.put_query("Who owns the club?", MODEL, VERSION, "The Glazers.")
+    assert cache.get(question, MODEL, VERSION) is None
+    assert cache.get_query("Who owns the club?", MODEL, VERSION) is None
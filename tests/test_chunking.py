@@ -0,0 +1,178 @@
+# Equivalence of the section splitting with the implementation it replaced, which tokenized every prefix of a part
+# on its own to find the balanced split. The encoding is a small byte-pair encoding trained here with the
+# pre-tokenization pattern of cl100k_base, so the test needs no download but still has merged tokens, whitespace
+# runs and pieces that change at the end of a prefix:
+#   python -m pytest tests
+
+import os
+import sys
+from collections import Counter
+import numpy as np
+import pytest
+import regex
+import tiktoken
+
+# The chunking functions live in the database directory
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database"))
+import data_processing_functions as dpf
+
+MODEL = "test-bpe"
+# Pre-tokenization pattern of cl100k_base, the encoding of gpt-3.5-turbo
+CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+WORDS = (
+    "Manchester United Old Trafford Busby Babes treble Premier League FA Cup final goal season manager captain "
+    "Ferguson Charlton Best Law Cantona Giggs Scholes Keane Rooney Ronaldo Munich Europe won the of in and a "
+    "club's they'll didn't 1968 1999 2008 3–1 (UEFA) \"Red Devils\" £89m 90+3' ...".split()
+)
+SEPARATORS = [" ", " ", " ", " ", ". ", ".", ", ", "\n", "\n\n", "\n\n\n", " \n", "  ", ".\n\n", "\n* ", "\t"]
+
+
+def synthetic_text(rng: np.random.Generator, words: int) -> str:
+    """Returns wiki-like text with paragraphs, list items and runs of whitespace."""
+    parts = []
+    for _ in range(words):
+        parts.append(str(rng.choice(WORDS)))
+        parts.append(str(rng.choice(SEPARATORS)))
+    return "".join(parts)
+
+
+def trained_encoding(text: str, merges: int = 400) -> tiktoken.Encoding:
+    """Returns a byte-pair encoding with the most frequent merges of the text."""
+    words = Counter(tuple(bytes([b]) for b in piece.encode("utf-8")) for piece in regex.findall(CL100K_PATTERN, text))
+    ranks = {bytes([b]): b for b in range(256)}
+    for _ in range(merges):
+        pairs = Counter()
+        for word, count in words.items():
+            for pair in zip(word, word[1:]):
+                pairs[pair] += count
+        if not pairs:
+            break
+        (a, b), _ = pairs.most_common(1)[0]
+        ranks.setdefault(a + b, len(ranks))
+        merged = Counter()
+        for word, count in words.items():
+            out, i = [], 0
+            while i < len(word):
+                if i + 1 < len(word) and word[i] == a and word[i + 1] == b:
+                    out.append(a + b)
+                    i += 2
+                else:
+                    out.append(word[i])
+                    i += 1
+            merged[tuple(out)] += count
+        words = merged
+    return tiktoken.Encoding(MODEL, pat_str=CL100K_PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+
+ENCODING = trained_encoding(synthetic_text(np.random.default_rng(0), 20000))
+
+
+@pytest.fixture(autouse=True)
+def bpe_encoding(monkeypatch):
+    monkeypatch.setattr(dpf, "encoding_for", lambda model: ENCODING)
+    dpf.piece_pattern.cache_clear()
+    yield
+    dpf.piece_pattern.cache_clear()
+
+
+# The implementation before the split was made linear, with the model passed through
+def reference_halved(string: str, delimiter: str) -> list[str]:
+    chunks = string.split(delimiter)
+    if len(chunks) == 1:
+        return [string, ""]
+    elif len(chunks) == 2:
+        return chunks
+    total_tokens = dpf.num_tokens(string, model=MODEL)
+    halfway = total_tokens // 2
+    best_diff = halfway
+    for i, chunk in enumerate(chunks):
+        left = delimiter.join(chunks[: i + 1])
+        diff = abs(halfway - dpf.num_tokens(left, model=MODEL))
+        if diff >= best_diff:
+            break
+        else:
+            best_diff = diff
+    return [delimiter.join(chunks[:i]), delimiter.join(chunks[i:])]
+
+
+def reference_split(subsection: tuple[list[str], str], max_tokens: int, max_recursion: int = 5) -> list[str]:
+    titles, text = subsection
+    string = "\n\n".join(titles + [text])
+    if dpf.num_tokens(string, model=MODEL) <= max_tokens:
+        return [string]
+    elif max_recursion == 0:
+        return [dpf.truncated_string(string, model=MODEL, max_tokens=max_tokens, print_warning=False)]
+    for delimiter in ["\n\n", "\n", "."]:
+        left, right = reference_halved(text, delimiter)
+        if left == "" or right == "":
+            continue
+        results = []
+        for half in [left, right]:
+            results.extend(reference_split((titles, half), max_tokens, max_recursion - 1))
+        return results
+    return [dpf.truncated_string(string, model=MODEL, max_tokens=max_tokens, print_warning=False)]
+
+
+def test_encoding_merges():
+    # The test is only meaningful if tokens span several characters and pieces
+    tokens = ENCODING.encode("Manchester United won the treble in 1999.\n\nOld Trafford")
+    assert len(tokens) < 20
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_prefix_tokens_match_tokenizing_every_prefix(seed):
+    text = synthetic_text(np.random.default_rng(seed), 400)
+    starts = dpf.token_starts(text, model=MODEL)
+    pieces = dpf.piece_starts(text, model=MODEL)
+    for end in range(len(text) + 1):
+        assert dpf.prefix_tokens(text, end, starts, pieces, model=MODEL) == len(ENCODING.encode(text[:end])), end
+
+
+@pytest.mark.parametrize("seed", range(30))
+@pytest.mark.parametrize("delimiter", ["\n\n", "\n", "."])
+def test_halved_span_matches_reference(seed, delimiter):
+    text = synthetic_text(np.random.default_rng(100 + seed), 300)
+    (left_begin, left_end), (right_begin, right_end) = dpf.halved_span(text, 0, len(text), delimiter, model=MODEL)
+    assert [text[left_begin:left_end], text[right_begin:right_end]] == reference_halved(text, delimiter)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("max_tokens", [40, 100, 400])
+def test_split_matches_reference(seed, max_tokens, capsys):
+    section = (["Manchester United F.C.", "== History =="], synthetic_text(np.random.default_rng(200 + seed), 1500))
+    parts = dpf.split_strings_from_subsection(section, max_tokens=max_tokens, model=MODEL)
+    capsys.readouterr() # truncation warnings
+    assert parts == reference_split(section, max_tokens)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("head", ["", "Manchester United F.C.\n\n== History ==\n\n", "Title\n\n\n"])
+def test_span_tokens_match_tokenizing_every_span(seed, head):
+    rng = np.random.default_rng(300 + seed)
+    text = synthetic_text(rng, 600)
+    starts = dpf.token_starts(text, model=MODEL)
+    pieces = dpf.piece_starts(text, model=MODEL)
+    # Spans of every length, also ones that start in the middle of a piece or a run of whitespace
+    for begin, end in np.sort(rng.integers(0, len(text) + 1, size=(400, 2)), axis=1):
+        expected = len(ENCODING.encode(head + text[begin:end]))
+        assert dpf.span_tokens(text, int(begin), int(end), starts, pieces, model=MODEL, head=head) == expected, (begin, end)
+
+
+class WithoutPattern:
+    """The test encoding as a tiktoken version without the _pat_str attribute would have it."""
+
+    def __getattr__(self, name: str):
+        if name == "_pat_str":
+            raise AttributeError(name)
+        return getattr(ENCODING, name)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_split_without_the_piece_pattern(seed, monkeypatch, capsys):
+    # tiktoken keeps the pattern in a private attribute, without it spans are tokenized on their own
+    monkeypatch.setattr(dpf, "encoding_for", lambda model: WithoutPattern())
+    assert dpf.piece_pattern(MODEL) is None
+    section = (["Manchester United F.C."], synthetic_text(np.random.default_rng(400 + seed), 1500))
+    parts = dpf.split_strings_from_subsection(section, max_tokens=100, model=MODEL)
+    capsys.readouterr()
+    assert parts == reference_split(section, max_tokens=100)
@@ -0,0 +1,111 @@
+# The batched embedding stage against the local stand-in of the OpenAI embeddings endpoint: retries of failed
+# requests, resuming from checkpoints and the order of the embeddings:
+#   python -m pytest tests
+
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+import numpy as np
+import openai
+import pytest
+
+# The build modules live in the database directory
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database"))
+from embedding_pipeline import EMBEDDING_MODEL, batch_checkpoint_path, embed_strings
+from fake_embeddings_server import FakeEmbeddingsHandler, fake_embedding
+
+DIM = 16
+STRINGS = [f"Manchester United section {i}" for i in range(250)]
+
+
+class CountingHandler(FakeEmbeddingsHandler):
+    dim = DIM
+    requests = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        with self.lock:
+            self.requests.append(self.path)
+        super().do_POST()
+
+
+class ReversedHandler(CountingHandler):
+    # The API does not promise the order of the embeddings, only their indices
+    def _send_json(self, status: int, body: dict):
+        if "data" in body:
+            body["data"] = body["data"][::-1]
+        super()._send_json(status, body)
+
+
+def serve(handler: type) -> tuple[ThreadingHTTPServer, openai.OpenAI]:
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The client's own retries are off, so every retry is made by the pipeline
+    client = openai.OpenAI(api_key="test", base_url=f"http://localhost:{server.server_port}/v1", max_retries=0)
+    return server, client
+
+
+@pytest.fixture
+def handler(request):
+    # A fresh subclass per test, so the request log and the fail rate are not shared
+    base = getattr(request, "param", CountingHandler)
+    return type("Handler", (base,), {"requests": [], "fail_rate": 0.0})
+
+
+@pytest.fixture
+def client(handler):
+    server, client = serve(handler)
+    yield client
+    server.shutdown()
+    server.server_close()
+
+
+def expected(strings: list[str]) -> np.ndarray:
+    return np.array([fake_embedding(string, DIM) for string in strings], dtype=np.float32)
+
+
+@pytest.mark.parametrize("handler", [CountingHandler, ReversedHandler], indirect=True)
+def test_embeddings_keep_the_order_of_the_strings(handler, client):
+    embeddings = embed_strings(client, STRINGS, batch_size=20, max_workers=4)
+    np.testing.assert_allclose(embeddings, expected(STRINGS), rtol=1e-6)
+    assert len(handler.requests) == 13
+
+
+def test_failed_requests_are_retried(handler, client):
+    handler.fail_rate = 0.5
+    embeddings = embed_strings(client, STRINGS, batch_size=20, max_workers=4, max_retries=40, backoff=0)
+    np.testing.assert_allclose(embeddings, expected(STRINGS), rtol=1e-6)
+    assert len(handler.requests) > 13
+
+
+def test_request_fails_after_all_retries(handler, client):
+    handler.fail_rate = 1.0
+    with pytest.raises(openai.RateLimitError):
+        embed_strings(client, STRINGS[:5], max_retries=2, backoff=0)
+    assert len(handler.requests) == 3
+
+
+def test_build_resumes_from_checkpoints(handler, client, tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    # The build is interrupted after the first 100 strings
+    embed_strings(client, STRINGS[:100], batch_size=50, checkpoint_dir=checkpoint_dir)
+    assert len(handler.requests) == 2
+    assert len(os.listdir(checkpoint_dir)) == 2
+    handler.requests.clear()
+    embeddings = embed_strings(client, STRINGS, batch_size=50, checkpoint_dir=checkpoint_dir)
+    np.testing.assert_allclose(embeddings, expected(STRINGS), rtol=1e-6)
+    # Only the three batches that had no checkpoint are requested
+    assert len(handler.requests) == 3
+    assert not [name for name in os.listdir(checkpoint_dir) if name.endswith(".tmp")]
+
+
+def test_changed_batch_does_not_reuse_its_checkpoint(handler, client, tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    embed_strings(client, STRINGS[:50], batch_size=50, checkpoint_dir=checkpoint_dir)
+    changed = ["A new section"] + STRINGS[1:50]
+    assert not os.path.exists(batch_checkpoint_path(checkpoint_dir, changed, EMBEDDING_MODEL))
+    handler.requests.clear()
+    embeddings = embed_strings(client, changed, batch_size=50, checkpoint_dir=checkpoint_dir)
+    np.testing.assert_allclose(embeddings, expected(changed), rtol=1e-6)
+    assert len(handler.requests) == 1
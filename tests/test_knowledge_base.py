@@ -0,0 +1,126 @@
+# The binary store and the deltas of incremental rebuilds: a delta written against the base store and applied to
+# it gives the new store, and a store caught in the middle of a save is not loaded as if it were whole:
+#   python -m pytest tests
+
+import hashlib
+import logging
+import os
+import sys
+import numpy as np
+import pytest
+
+# The bot modules live one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from knowledge_base import KnowledgeBase, load_delta, normalized
+from vector_index import ExactIndex, IVFIndex
+
+DIM = 8
+ENCODING = "test"
+
+
+def knowledge_base(texts: list[str]) -> KnowledgeBase:
+    """Returns a knowledge base where the same text always has the same embedding, as after a real build."""
+    embeddings = normalized(np.array([
+        np.random.default_rng(int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)).normal(size=DIM)
+        for text in texts
+    ], dtype=np.float32))
+    token_counts = {ENCODING: np.array([len(text.split()) for text in texts], dtype=np.int32)}
+    return KnowledgeBase(np.asarray(texts, dtype=object), embeddings, token_counts)
+
+
+def rows(kb: KnowledgeBase) -> list[tuple]:
+    """Returns the texts with their embeddings and token counts in a fixed order."""
+    return sorted(
+        (text, tuple(np.asarray(embedding).round(6)), int(count))
+        for text, embedding, count in zip(kb.texts, kb.embeddings, kb.token_counts[ENCODING])
+    )
+
+
+BASE_TEXTS = [
+    "Old Trafford is the home of the club",
+    "The Busby Babes",
+    "The Busby Babes", # the same text in two articles
+    "Munich air disaster",
+    "Treble of 1999",
+    "Red Devils",
+]
+NEW_TEXTS = [
+    "Red Devils",
+    "The Busby Babes",
+    "The Busby Babes",
+    "The Busby Babes", # one more occurrence of a kept text
+    "Old Trafford is the home of the club",
+    "Munich air disaster",
+    "Treble of 1999 and 2008", # edited text
+    "Red Devils",
+    "Glazer ownership", # new text
+]
+
+
+@pytest.mark.parametrize("index", ["exact", "ivf"])
+def test_delta_round_trip(tmp_path, index):
+    path = str(tmp_path / "kb")
+    base = knowledge_base(BASE_TEXTS)
+    if index == "ivf":
+        base.index = IVFIndex.build(base.embeddings, n_lists=2)
+    base.ensure_lexical_index()
+    base.save(path)
+    loaded = KnowledgeBase.load(path, index=index)
+
+    new = knowledge_base(NEW_TEXTS)
+    new.save_delta(path, base=base)
+    delta = load_delta(path)
+    assert delta["removed"] == [hashlib.sha1("Treble of 1999".encode("utf-8")).hexdigest()]
+    assert sorted(delta["texts"]) == sorted(["The Busby Babes", "Treble of 1999 and 2008", "Red Devils", "Glazer ownership"])
+
+    applied = loaded.apply_delta(delta)
+    assert applied.version == new.version
+    assert len(applied) == len(new)
+    assert rows(applied) == rows(new)
+    assert isinstance(applied.index, IVFIndex if index == "ivf" else ExactIndex)
+    assert applied.lexical is not None and applied.lexical.count == len(new)
+
+
+def test_delta_that_does_not_add_up_is_rejected(tmp_path):
+    path = str(tmp_path / "kb")
+    base = knowledge_base(BASE_TEXTS)
+    new = knowledge_base(NEW_TEXTS)
+    new.save_delta(path, base=base)
+    delta = load_delta(path)
+    delta["count"] += 1
+    with pytest.raises(ValueError):
+        base.apply_delta(delta)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "kb")
+    kb = knowledge_base(NEW_TEXTS)
+    kb.save(path)
+    loaded = KnowledgeBase.load(path)
+    assert loaded.version == kb.version
+    assert rows(loaded) == rows(kb)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_embeddings_of_an_unfinished_save_are_detected(tmp_path):
+    path = str(tmp_path / "kb")
+    knowledge_base(BASE_TEXTS).save(path)
+    # A save of a store of the same size stopped after replacing the embeddings, the texts are still the old ones
+    other = knowledge_base([text + " (edited)" for text in BASE_TEXTS])
+    np.save(path + ".npy", other.embeddings)
+    with pytest.raises(ValueError, match="not the ones recorded"):
+        KnowledgeBase.load(path)
+
+
+def test_index_of_another_version_is_not_used(tmp_path, caplog):
+    path = str(tmp_path / "kb")
+    kb = knowledge_base(BASE_TEXTS)
+    kb.index = IVFIndex.build(kb.embeddings, n_lists=2)
+    kb.save(path)
+    assert isinstance(KnowledgeBase.load(path, index="ivf").index, IVFIndex)
+    other = knowledge_base(BASE_TEXTS[::-1])
+    IVFIndex.build(other.embeddings, n_lists=2).save(path, version=other.version)
+    with caplog.at_level(logging.WARNING):
+        loaded = KnowledgeBase.load(path, index="ivf")
+    assert isinstance(loaded.index, ExactIndex)
+    assert "searched exactly" in caplog.text
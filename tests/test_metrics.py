@@ -0,0 +1,32 @@
+# The metrics endpoint must never stop the bot, e.g. when another exporter has taken its port:
+#   python -m pytest tests
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+# The bot modules live one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import start_metrics_server
+
+
+def test_taken_port_is_logged_and_skipped(caplog):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        with caplog.at_level(logging.ERROR):
+            runner = asyncio.run(start_metrics_server("127.0.0.1", port))
+    assert runner is None
+    assert f"127.0.0.1:{port}" in caplog.text
+
+
+def test_metrics_are_served():
+    async def serve_and_stop():
+        runner = await start_metrics_server("127.0.0.1", 0)
+        await runner.cleanup()
+        return runner
+
+    assert asyncio.run(serve_and_stop()) is not None
@@ -0,0 +1,220 @@
+# The scheduler in front of the answer pipeline with a stub pipeline that answers when it is told to: coalescing of
+# identical questions, token buckets, round-robin handoff of slots, waiting and shedding:
+#   python -m pytest tests
+
+import asyncio
+import os
+import sys
+import pytest
+
+# The bot modules live one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import request_scheduler
+from request_scheduler import RateLimited, RequestScheduler, SchedulerBusy, TokenBuckets
+
+
+class StubPipeline:
+    """Answer pipeline that records the questions it is asked and answers them once released."""
+
+    def __init__(self):
+        self.started = []
+        self.released = asyncio.Event()
+
+    async def run(self, query: str):
+        self.started.append(query)
+        await self.released.wait()
+        yield query.upper()
+        yield "!"
+
+
+async def answer(stream) -> str:
+    """Reads the whole answer and closes the stream, like the bot handler."""
+    try:
+        return "".join([piece async for piece in stream])
+    finally:
+        await stream.aclose()
+
+
+async def settle():
+    # Let the started tasks run until they wait for something
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def assert_idle(scheduler: RequestScheduler):
+    assert scheduler._active == 0
+    assert scheduler._queued == 0
+    assert not scheduler._waiters
+    assert not scheduler._in_flight
+
+
+def test_identical_questions_share_one_answer():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=2, user_burst=10)
+        pipeline = StubPipeline()
+        leader = asyncio.create_task(answer(scheduler.submit(1, "Who owns the club?", pipeline.run)))
+        await settle()
+        follower = asyncio.create_task(answer(scheduler.submit(2, "who owns the club", pipeline.run)))
+        await settle()
+        pipeline.released.set()
+        assert await leader == "WHO OWNS THE CLUB?!"
+        assert await follower == "WHO OWNS THE CLUB?!"
+        assert pipeline.started == ["Who owns the club?"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_followers_of_an_abandoned_leader_are_told_to_retry():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=2, user_burst=10)
+        pipeline = StubPipeline()
+        # The leader is closed before it is read, e.g. the handler failed to send its first message
+        leader = scheduler.submit(1, "Who owns the club?", pipeline.run)
+        follower = asyncio.create_task(answer(scheduler.submit(2, "Who owns the club?", pipeline.run)))
+        await settle()
+        await leader.aclose()
+        with pytest.raises(SchedulerBusy):
+            await follower
+        assert pipeline.started == []
+        assert_idle(scheduler)
+
+        # The leader is cancelled while its answer is being generated
+        leader = asyncio.create_task(answer(scheduler.submit(1, "Who owns the club?", pipeline.run)))
+        await settle()
+        follower = asyncio.create_task(answer(scheduler.submit(2, "Who owns the club?", pipeline.run)))
+        await settle()
+        leader.cancel()
+        with pytest.raises(SchedulerBusy):
+            await follower
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(request_scheduler.time, "monotonic", lambda: now[0])
+    buckets = TokenBuckets(rate=0.5, burst=2)
+    buckets.take("user")
+    buckets.take("user")
+    with pytest.raises(RateLimited) as limited:
+        buckets.take("user")
+    assert limited.value.retry_after == pytest.approx(2.0)
+    # Other users have buckets of their own
+    buckets.take("other user")
+    now[0] += 1.0
+    with pytest.raises(RateLimited) as limited:
+        buckets.take("user")
+    assert limited.value.retry_after == pytest.approx(1.0)
+    now[0] += 1.0
+    buckets.take("user")
+    # A long pause refills only up to the burst size
+    now[0] += 100.0
+    buckets.take("user")
+    buckets.take("user")
+    with pytest.raises(RateLimited):
+        buckets.take("user")
+
+
+def test_rate_limited_question_is_refused_before_any_work():
+    async def scenario():
+        scheduler = RequestScheduler(user_rate=0.01, user_burst=1)
+        pipeline = StubPipeline()
+        pipeline.released.set()
+        assert await answer(scheduler.submit(1, "First question", pipeline.run)) == "FIRST QUESTION!"
+        with pytest.raises(RateLimited):
+            scheduler.submit(1, "Second question", pipeline.run)
+        assert pipeline.started == ["First question"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_slots_are_handed_round_robin_between_users():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_queued=10, user_burst=10)
+        pipeline = StubPipeline()
+        tasks = []
+        for user, query in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]:
+            tasks.append(asyncio.create_task(answer(scheduler.submit(user, query, pipeline.run))))
+            await settle()
+        assert pipeline.started == ["a1"]
+        assert scheduler._queued == 4
+        pipeline.released.set()
+        await asyncio.gather(*tasks)
+        # User a asked three questions first, but b and c get their turn after a's second one
+        assert pipeline.started == ["a1", "a2", "b1", "c1", "a3"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_question_waiting_too_long_is_shed():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_wait=0.05, user_burst=10)
+        pipeline = StubPipeline()
+        first = asyncio.create_task(answer(scheduler.submit(1, "First question", pipeline.run)))
+        await settle()
+        with pytest.raises(SchedulerBusy):
+            await answer(scheduler.submit(2, "Second question", pipeline.run))
+        assert scheduler._queued == 0
+        pipeline.released.set()
+        assert await first == "FIRST QUESTION!"
+        assert pipeline.started == ["First question"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiting_question_leaves_the_queue():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, user_burst=10)
+        pipeline = StubPipeline()
+        first = asyncio.create_task(answer(scheduler.submit(1, "First question", pipeline.run)))
+        await settle()
+        waiting = asyncio.create_task(answer(scheduler.submit(2, "Second question", pipeline.run)))
+        await settle()
+        assert scheduler._queued == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler._queued == 0
+        pipeline.released.set()
+        await first
+        # The slot is freed instead of being handed to the cancelled question
+        assert pipeline.started == ["First question"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_sheds_and_coalesces():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_queued=1, user_burst=10)
+        pipeline = StubPipeline()
+        outcomes = {}
+        tasks = {}
+        # Five users, two of them ask what another one is already asking
+        for user, query in [(1, "Who owns the club?"), (2, "When was the club founded?"), (3, "who owns the club"),
+                            (4, "Who is the captain?"), (5, "When was the club founded")]:
+            try:
+                tasks[user] = asyncio.create_task(answer(scheduler.submit(user, query, pipeline.run)))
+            except SchedulerBusy:
+                outcomes[user] = "busy"
+            await settle()
+        assert scheduler._active == 1 and scheduler._queued == 1
+        pipeline.released.set()
+        for user, task in tasks.items():
+            outcomes[user] = await task
+        assert outcomes == {
+            1: "WHO OWNS THE CLUB?!", # answered
+            2: "WHEN WAS THE CLUB FOUNDED?!", # answered after waiting in the queue
+            3: "WHO OWNS THE CLUB?!", # coalesced with user 1
+            4: "busy", # shed, one question answered and one waiting is all there is room for
+            5: "WHEN WAS THE CLUB FOUNDED?!", # coalesced with user 2 while it was waiting
+        }
+        assert pipeline.started == ["Who owns the club?", "When was the club founded?"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
@@ -0,0 +1,138 @@
+# The Wikipedia crawl replayed from a small recorded site: the depth of the category walk and the wikitext
+# cache, which must not download a revision it already has:
+#   python -m pytest tests
+
+import json
+import os
+import sys
+import pytest
+
+# The build modules live in the database directory
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database"))
+from wiki_crawler import RecordedSite, WikiCrawler, request_key
+
+ROOT_CATEGORY = "Category:Manchester United F.C."
+
+
+def members_request(category: str, **continuation) -> tuple[str, dict]:
+    return "query", dict(list="categorymembers", cmtitle=category, cmlimit="max", formatversion=2, **continuation)
+
+
+def members_response(*members: tuple[int, str], **continuation) -> dict:
+    response = {"query": {"categorymembers": [{"ns": ns, "title": title} for ns, title in members]}}
+    if continuation:
+        response["continue"] = continuation
+    return response
+
+
+# Root: two pages, a file and a subcategory, split over two responses. The subcategory has a page and a
+# subcategory of its own, which has one more page and links back to the root
+CATEGORY_TREE = [
+    (members_request(ROOT_CATEGORY), members_response(
+        (0, "Old Trafford"), (6, "File:Crest.svg"), (14, "Category:Manchester United F.C. players"),
+        cmcontinue="page|next", **{"continue": "-||"},
+    )),
+    (members_request(ROOT_CATEGORY, cmcontinue="page|next", **{"continue": "-||"}), members_response(
+        (0, "Busby Babes"),
+    )),
+    (members_request("Category:Manchester United F.C. players"), members_response(
+        (0, "George Best"), (14, "Category:Manchester United F.C. captains"),
+    )),
+    (members_request("Category:Manchester United F.C. captains"), members_response(
+        (0, "Roy Keane"), (14, ROOT_CATEGORY),
+    )),
+]
+
+TITLES = ["Busby Babes", "George Best", "Old Trafford", "Roy Keane"]
+
+
+def revisions_request(titles: list[str]) -> tuple[str, dict]:
+    return "query", dict(prop="revisions", rvprop="ids", titles="|".join(titles), formatversion=2)
+
+
+def revisions_response(revision_ids: dict[str, int], missing: tuple[str, ...] = ()) -> dict:
+    pages = [{"title": title, "revisions": [{"revid": revid}]} for title, revid in revision_ids.items()]
+    pages += [{"title": title, "missing": True} for title in missing]
+    return {"query": {"pages": pages}}
+
+
+def texts_request(revision_ids: list[int]) -> tuple[str, dict]:
+    return "query", dict(
+        prop="revisions", rvprop="ids|content", rvslots="main",
+        revids="|".join(str(revision_id) for revision_id in revision_ids), formatversion=2,
+    )
+
+
+def texts_response(texts: dict[int, str]) -> dict:
+    return {"query": {"pages": [
+        {"revisions": [{"revid": revid, "slots": {"main": {"content": text}}}]} for revid, text in texts.items()
+    ]}}
+
+
+class CountingSite(RecordedSite):
+    """Recorded site that keeps the requests it has been asked."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.requests = []
+
+    def get(self, action: str, **kwargs) -> dict:
+        self.requests.append(kwargs)
+        return super().get(action, **kwargs)
+
+    def text_requests(self) -> list[str]:
+        return [kwargs["revids"] for kwargs in self.requests if "revids" in kwargs]
+
+
+def recorded_site(path, recordings: list[tuple[tuple[str, dict], dict]]) -> CountingSite:
+    """Writes the responses in the format of RecordingSite and returns a site that replays them."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({request_key(action, kwargs): response for (action, kwargs), response in recordings}, f)
+    return CountingSite(str(path))
+
+
+@pytest.mark.parametrize("max_depth, titles", [
+    (0, {"Old Trafford", "Busby Babes"}),
+    (1, {"Old Trafford", "Busby Babes", "George Best"}),
+    (2, set(TITLES)),
+    (5, set(TITLES)),
+])
+def test_category_depth(tmp_path, max_depth, titles):
+    site = recorded_site(tmp_path / "site.json", CATEGORY_TREE)
+    crawler = WikiCrawler(site=site, cache_dir=str(tmp_path / "cache"), max_workers=2)
+    assert crawler.titles_from_category(ROOT_CATEGORY, max_depth=max_depth) == titles
+    # Every category is listed once, the link back to the root is not followed
+    listed = [kwargs["cmtitle"] for kwargs in site.requests if "cmcontinue" not in kwargs]
+    assert len(listed) == len(set(listed))
+
+
+def test_cached_revisions_are_not_fetched_again(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    revision_ids = {"Busby Babes": 11, "George Best": 12, "Old Trafford": 13, "Roy Keane": 14}
+    texts = {revid: f"Wikitext of {title}" for title, revid in revision_ids.items()}
+    # Titles are requested in sorted order
+    titles = sorted(TITLES + ["Missing page"])
+    site = recorded_site(tmp_path / "first.json", [
+        (revisions_request(titles[:2]), revisions_response({"Busby Babes": 11, "George Best": 12})),
+        (revisions_request(titles[2:4]), revisions_response({"Old Trafford": 13}, missing=("Missing page",))),
+        (revisions_request(titles[4:]), revisions_response({"Roy Keane": 14})),
+        (texts_request([11, 12, 13]), texts_response({11: texts[11], 12: texts[12], 13: texts[13]})),
+        (texts_request([14]), texts_response({14: texts[14]})),
+    ])
+    crawler = WikiCrawler(site=site, cache_dir=cache_dir, max_workers=2, titles_per_request=2, texts_per_request=3)
+    assert crawler.page_texts(titles) == {title: texts[revid] for title, revid in revision_ids.items()}
+    assert sorted(site.text_requests()) == ["11|12|13", "14"]
+
+    # The next build finds one page edited, only its new revision is downloaded
+    site = recorded_site(tmp_path / "second.json", [
+        (revisions_request(titles[:2]), revisions_response({"Busby Babes": 11, "George Best": 15})),
+        (revisions_request(titles[2:4]), revisions_response({"Old Trafford": 13}, missing=("Missing page",))),
+        (revisions_request(titles[4:]), revisions_response({"Roy Keane": 14})),
+        (texts_request([15]), texts_response({15: "Edited wikitext of George Best"})),
+    ])
+    crawler = WikiCrawler(site=site, cache_dir=cache_dir, max_workers=2, titles_per_request=2, texts_per_request=3)
+    pages = crawler.page_texts(titles)
+    assert site.text_requests() == ["15"]
+    assert pages["George Best"] == "Edited wikitext of George Best"
+    assert pages["Roy Keane"] == texts[14]
+    assert not [name for name in os.listdir(cache_dir) if name.endswith(".tmp")]
@@ -0,0 +1,181 @@
+# Vector indexes the knowledge base is searched with. ExactIndex compares the query with every embedding,
+# IVFIndex (inverted file) only with the embeddings in the clusters closest to the query, which trades a little recall
+# for search time that grows much slower than the knowledge base
+
+import os
+import numpy as np
+
+
+# Pick the top n candidates and sort them, shared by all indexes so that they order results the same way
+def top_n_sorted(
+    relatednesses: np.ndarray, # (n_queries, n_candidates) similarities of the candidates
+    candidates: np.ndarray, # (n_queries, n_candidates) knowledge base indices of the candidates
+    top_n: int, # select top n results
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns indices and relatednesses of the top n candidates sorted from largest to smallest."""
+    top_n = min(top_n, relatednesses.shape[1])
+    if top_n < relatednesses.shape[1]:
+        # Select the top n candidates of every query in linear time, only they need to be sorted
+        selected = np.argpartition(-relatednesses, top_n - 1, axis=1)[:, :top_n]
+        relatednesses = np.take_along_axis(relatednesses, selected, axis=1)
+        candidates = np.take_along_axis(candidates, selected, axis=1)
+    # Sort by descending similarity, equal scores keep the knowledge base order like a stable sort does
+    order = np.lexsort((candidates, -relatednesses))
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(relatednesses, order, axis=1)
+
+
+class ExactIndex:
+    """Exact search: one matrix product of the queries with all embeddings."""
+
+    name = "exact"
+
+    def __init__(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def search(
+        self,
+        queries: np.ndarray, # (n_queries, dim) matrix of normalized query embeddings
+        top_n: int, # select top n results
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (n_queries, top_n) arrays of indices and relatednesses sorted from largest to smallest."""
+        relatednesses = queries @ self.embeddings.T
+        candidates = np.broadcast_to(np.arange(len(self.embeddings)), relatednesses.shape)
+        return top_n_sorted(relatednesses, candidates, top_n)
+
+    def save(self, path: str, version: str | None = None) -> None:
+        """The exact index has nothing to store besides the embeddings."""
+
+
+class IVFIndex:
+    """
+    Approximate search with an inverted file: embeddings are grouped into clusters around centroids found with k-means,
+    and a query is compared only with the embeddings of the nprobe clusters whose centroids are closest to it.
+    More clusters make every cluster smaller and the search faster, a larger nprobe gives better recall.
+    """
+
+    name = "ivf"
+
+    def __init__(
+        self,
+        embeddings: np.ndarray, # (n, dim) matrix of normalized embeddings
+        centroids: np.ndarray, # (n_lists, dim) matrix of normalized cluster centroids
+        list_offsets: np.ndarray, # list i holds list_ids[list_offsets[i]:list_offsets[i + 1]]
+        list_ids: np.ndarray, # knowledge base indices grouped by cluster
+        nprobe: int = 8, # number of clusters searched for every query
+        version: str | None = None, # version of the knowledge base the index was saved with, checked when it is loaded
+    ):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+        self.version = version
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray, # (n, dim) matrix of normalized embeddings
+        n_lists: int | None = None, # number of clusters, about 4 * sqrt(n) by default
+        n_iter: int = 10, # number of k-means iterations
+        sample_size: int = 256, # k-means is trained on at most sample_size embeddings per cluster
+        nprobe: int = 8, # number of clusters searched for every query
+        seed: int = 0, # random seed of k-means
+    ) -> "IVFIndex":
+        """Clusters the embeddings with spherical k-means and builds the inverted lists."""
+        rng = np.random.default_rng(seed)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(embeddings))))
+        n_lists = min(n_lists, len(embeddings))
+        sample = embeddings
+        if len(embeddings) > sample_size * n_lists:
+            sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size * n_lists, replace=False))]
+        sample = np.asarray(sample, dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = cls._assign(sample, centroids)
+            # New centroid of every cluster is the normalized mean of its members, empty clusters keep the old one
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            non_empty = norms[:, 0] > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+        return cls.from_centroids(embeddings, centroids, nprobe=nprobe)
+
+    @classmethod
+    def from_centroids(
+        cls,
+        embeddings: np.ndarray, # (n, dim) matrix of normalized embeddings
+        centroids: np.ndarray, # (n_lists, dim) matrix of normalized cluster centroids
+        nprobe: int = 8, # number of clusters searched for every query
+    ) -> "IVFIndex":
+        """Builds the inverted lists by assigning every embedding to its closest centroid."""
+        assignment = cls._assign(embeddings, centroids)
+        list_ids = np.argsort(assignment, kind="stable").astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))])
+        return cls(embeddings, centroids, list_offsets, list_ids, nprobe=nprobe)
+
+    @staticmethod
+    def _assign(embeddings: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        # Assign in batches, so the similarity matrix stays small for a large knowledge base
+        assignment = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            assignment[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return assignment
+
+    def search(
+        self,
+        queries: np.ndarray, # (n_queries, dim) matrix of normalized query embeddings
+        top_n: int, # select top n results
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (n_queries, top_n) arrays of indices and relatednesses sorted from largest to smallest."""
+        top_n = min(top_n, len(self.embeddings))
+        list_sizes = np.diff(self.list_offsets)
+        # Clusters of every query from the closest centroid to the farthest
+        list_order = np.argsort(-(queries @ self.centroids.T), axis=1, kind="stable")
+        results = [], []
+        for query, lists in zip(queries, list_order):
+            # Search nprobe clusters, and more if they hold fewer than top n embeddings
+            n_probed = max(min(self.nprobe, len(lists)), int(np.searchsorted(np.cumsum(list_sizes[lists]), top_n)) + 1)
+            # Sorted candidates read the embeddings in file order, which is friendlier to a memory-mapped matrix
+            candidates = np.sort(np.concatenate(
+                [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists[:n_probed]]
+            ))
+            relatednesses = np.asarray(self.embeddings[candidates] @ query)
+            indices, relatednesses = top_n_sorted(relatednesses[None, :], candidates[None, :], top_n)
+            results[0].append(indices[0])
+            results[1].append(relatednesses[0])
+        return np.stack(results[0]), np.stack(results[1])
+
+    def save(
+        self,
+        path: str, # store path without extension
+        version: str | None = None, # version of the knowledge base the index belongs to
+    ) -> None:
+        """Writes the centroids and inverted lists to "<path>.ivf.npz" next to the embeddings."""
+        self.version = version
+        with open(path + ".ivf.npz.tmp", "wb") as f:
+            np.savez(
+                f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids, version=version or ""
+            )
+        os.replace(path + ".ivf.npz.tmp", path + ".ivf.npz")
+
+    @classmethod
+    def load(
+        cls,
+        path: str, # store path without extension
+        embeddings: np.ndarray, # (n, dim) matrix of normalized embeddings the index was built for
+        nprobe: int = 8, # number of clusters searched for every query
+        version: str | None = None, # version of the knowledge base the index must belong to, None accepts any
+    ) -> "IVFIndex":
+        """Loads the index written by save()."""
+        with np.load(path + ".ivf.npz") as data:
+            # Indexes saved before versions were recorded have none
+            saved_version = (str(data["version"]) if "version" in data.files else "") or None
+            index = cls(
+                embeddings, data["centroids"], data["list_offsets"], data["list_ids"], nprobe=nprobe, version=saved_version
+            )
+        if version is not None and saved_version is not None and saved_version != version:
+            raise ValueError(f"Index in {path}.ivf.npz was saved with version {saved_version}, not {version}")
+        if len(index.list_ids) != len(embeddings):
+            raise ValueError(f"Index in {path}.ivf.npz was built for a different knowledge base")
+        return index
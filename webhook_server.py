@@ -0,0 +1,164 @@
+# Webhook deployment of the bot: a local aiohttp server receives updates from Telegram and fans them out to a pool
+# of worker processes, so answering questions uses every core of the machine instead of one. Updates of one chat
+# always go to the same worker, which keeps their order. Every worker memory-maps the same knowledge base store,
+# so the embedding matrix sits once in the page cache instead of being loaded by every process
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from aiohttp import web
+from bot_functions import bot
+from df import ensure_store
+from metrics import Counter, Gauge, register_callback, start_metrics_server
+
+# Public https address Telegram sends the updates to, the webhook path is appended to it
+WEBHOOK_URL = os.getenv('webhook_url')
+WEBHOOK_PATH = os.getenv('webhook_path', '/webhook')
+# Address of the local server, usually behind a reverse proxy that terminates https
+WEBHOOK_HOST = os.getenv('webhook_host', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('webhook_port', os.getenv('PORT', 8080)))
+# Telegram sends this secret with every update, requests without it are rejected
+WEBHOOK_SECRET = os.getenv('webhook_secret')
+# Number of worker processes answering the updates, one per core by default
+BOT_WORKERS = int(os.getenv('bot_workers', os.cpu_count() or 1))
+# Updates waiting for one worker, when its queue is full Telegram is asked to deliver the update again later
+WORKER_QUEUE_SIZE = int(os.getenv('worker_queue_size', 1000))
+
+UPDATES = Counter("bot_webhook_updates_total", "Updates received on the webhook by the worker they were sent to")
+QUEUE_DEPTH = Gauge("bot_worker_queue_depth", "Updates waiting in the queue of every worker")
+
+
+# Updates are routed by chat, so one worker handles all messages of a conversation in order
+def routing_key(update: dict) -> int:
+    """Returns the id of the chat or user the update belongs to, or the update id if it has neither."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat is not None:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user is not None:
+            return user["id"]
+    return update.get("update_id", 0)
+
+
+def worker_process(
+    updates: multiprocessing.Queue, # queue of raw updates sent to this worker, None stops it
+    number: int, # number of the worker, from 0
+    background: tuple, # coroutine functions run next to answering the updates
+    metrics_host: str,
+    metrics_port: int, # metrics of the worker are served on metrics_port + 1 + number, 0 turns them off
+) -> None:
+    """Entry point of a worker process: answers the updates sent to it until it receives None."""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_worker(updates, number, background, metrics_host, metrics_port))
+
+
+async def run_worker(updates: multiprocessing.Queue, number: int, background: tuple, metrics_host: str, metrics_port: int):
+    # Every worker has its own bot session, dispatcher, caches and metrics, only the store is shared
+    from bot_functions import dp
+    from df import kb_ready
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(function()) for function in background]
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await start_metrics_server(metrics_host, metrics_port + 1 + number, ready=kb_ready)
+    logging.info(f"Worker {number} is ready for updates")
+
+    async def handle(update: dict):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            # feed_raw_update raises the errors of the handlers without logging them, unlike polling
+            logging.exception(f"Worker {number} failed to handle update {update.get('update_id')}")
+
+    # Updates are answered concurrently, like in polling mode
+    handling = set()
+    while True:
+        update = await loop.run_in_executor(None, updates.get)
+        if update is None:
+            break
+        task = asyncio.create_task(handle(update))
+        handling.add(task)
+        task.add_done_callback(handling.discard)
+    await asyncio.gather(*handling)
+    for task in tasks:
+        task.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await bot.session.close()
+
+
+def run_webhook(
+    background: tuple = (), # coroutine functions every worker runs, e.g. hot-loading the knowledge base
+    metrics_host: str = '127.0.0.1',
+    metrics_port: int = 0, # metrics of the server on this port and of worker i on metrics_port + 1 + i, 0 turns them off
+) -> None:
+    """Runs the webhook server and the worker processes until the server is stopped."""
+    if not WEBHOOK_URL:
+        raise ValueError("bot_mode=webhook needs webhook_url, the public address Telegram sends the updates to")
+    # Convert the legacy CSV once here, otherwise every worker would try to do it at the same time
+    ensure_store()
+    # Workers are spawned, so they start from a clean interpreter instead of a copy of this one
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(BOT_WORKERS)]
+    workers = [
+        context.Process(
+            target=worker_process, args=(updates, number, background, metrics_host, metrics_port), daemon=True
+        )
+        for number, updates in enumerate(queues)
+    ]
+
+    def export_queue_depth() -> None:
+        for number, updates in enumerate(queues):
+            try:
+                QUEUE_DEPTH.set(updates.qsize(), worker=str(number))
+            except NotImplementedError:
+                return # qsize() is not available on macOS
+
+    register_callback(export_queue_depth)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        update = await request.json()
+        number = routing_key(update) % len(queues)
+        try:
+            queues[number].put_nowait(update)
+        except queue.Full:
+            logging.warning(f"Queue of worker {number} is full, update {update.get('update_id')} is left to Telegram to retry")
+            return web.Response(status=503)
+        UPDATES.inc(worker=str(number))
+        return web.Response()
+
+    async def on_startup(app: web.Application):
+        for worker in workers:
+            worker.start()
+        if metrics_port:
+            app["metrics_runner"] = await start_metrics_server(
+                metrics_host, metrics_port, ready=lambda: all(worker.is_alive() for worker in workers)
+            )
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        logging.info(f"Webhook server listens on {WEBHOOK_HOST}:{WEBHOOK_PORT} with {len(workers)} workers")
+
+    async def on_cleanup(app: web.Application):
+        # Let the workers finish the updates they have, then stop them
+        for updates in queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+            if worker.is_alive():
+                worker.terminate()
+        if app.get("metrics_runner") is not None:
+            await app["metrics_runner"].cleanup()
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)